@@ -1,13 +1,28 @@
 #!/usr/bin/env python3
 import glob
+import hashlib
 import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 from PIL import Image, ImageEnhance, ImageFont, ImageDraw, ImageFilter
 from settings import *
 
-canny_low = CANNY_LOW
-canny_high = CANNY_HIGH
+# canny thresholds calibrated per scan profile (device, mode, resolution)
+canny_cache = {}
+canny_lock = threading.Lock()
+# rendered layers, the least recently used first
+layer_cache = OrderedDict()
+layer_bytes = 0
+layer_lock = threading.Lock()
+# outputs of the processing stages, the least recently used first
+stage_cache = OrderedDict()
+stage_bytes = 0
+# pages are processed in the background too
+stage_lock = threading.Lock()
 IPTEST = [
         'find_canny_thresholds',
         'GetRectifiedImage',
@@ -19,91 +34,195 @@ IPTEST = [
 # https://gist.github.com/shunsukeaihara/4603234
 #
 def from_pil(pimg):
-    pimg = pimg.convert(mode='RGB')
-    nimg = np.asarray(pimg)
-    nimg.flags.writeable = True
+    if pimg.mode != 'RGB':
+        pimg = pimg.convert(mode='RGB')
+    # writable copy: the white balances work in place
+    return np.array(pimg)
+
+#
+# PIL image of the page buffer: gray pages share it, PIL keeps RGB in
+# four bytes a pixel. Lineart pages are thresholded back to one bit when
+# their mode is given.
+#
+def to_pil(nimg, mode=None):
+    nimg = np.ascontiguousarray(nimg, dtype=np.uint8)
+    if nimg.ndim == 2:
+        img = Image.frombuffer('L', (nimg.shape[1], nimg.shape[0]), nimg,
+                'raw', 'L', 0, 1)
+        return img.convert('1', dither=Image.NONE) if mode == '1' else img
+
+    return Image.fromarray(nimg)
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+# Tiled processing: the page buffer is processed in bands of TILE_ROWS rows,
+# the bands in parallel (OpenCV and PIL release the GIL). A neighbourhood
+# operation gets a halo of rows around its band, taken before any band is
+# written, so that each band is written back in place. The halo is cut at
+# the top and bottom of the page unless it is reflected there.
+#
+def process_tiles(nimg, fn, halo=0, reflect=False):
+    h = nimg.shape[0]
+    rows = TILE_ROWS if TILE_ROWS > 0 else h
+    bands = [(y, min(y + rows, h)) for y in range(0, h, rows)]
+
+    # halo rows as they are before any band is written
+    above, below = {}, {}
+    if halo > 0:
+        for (y0,y1) in bands:
+            above[y0] = nimg[max(y0 - halo, 0):y0].copy()
+            below[y1] = nimg[y1:y1 + halo].copy()
+        if reflect:
+            above[0] = nimg[:halo][::-1].copy()
+            below[h] = nimg[h - halo:][::-1].copy()
+
+    def work(band):
+        (y0,y1) = band
+        if halo > 0:
+            tile = np.concatenate((above[y0], nimg[y0:y1], below[y1]))
+        else:
+            tile = nimg[y0:y1]
+
+        out = fn(tile)
+        top = len(above.get(y0, ()))
+        if not np.shares_memory(out, nimg):
+            nimg[y0:y1] = out[top:top + y1 - y0]
+
+    if TILE_THREADS > 1 and len(bands) > 1:
+        with ThreadPoolExecutor(TILE_THREADS) as pool:
+            list(pool.map(work, bands))
+    else:
+        for band in bands:
+            work(band)
+
+    return nimg
+
+#
+# writable page buffer of the image, RGB or gray: lineart is kept gray, a
+# byte a pixel, and not made RGB
+#
+def page_buffer(img):
+    if img.mode == '1':
+        img = img.convert('L')
+    elif img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+
+    return np.array(img)
+
+#
+# the buffer in RGB
+#
+def rgb_buffer(nimg):
+    if nimg.ndim == 2:
+        return cv2.cvtColor(nimg, cv2.COLOR_GRAY2RGB)
 
     return nimg
 
-def to_pil(nimg):
-    return Image.fromarray(np.uint8(nimg))
+#
+# The white balances below derive the gains from the channel histograms
+# and apply them in place through lookup tables, so that no full size
+# temporary is made. Values are truncated as the original float code did.
+# A gray buffer has a single channel.
+#
+def histograms(nimg):
+    bins = np.iinfo(nimg.dtype).max + 1
+    return [cv2.calcHist([nimg], [c], None, [bins], [0, bins]).ravel()
+            for c in range(nimg.shape[2] if nimg.ndim == 3 else 1)]
+
+def apply_luts(nimg, luts):
+    if nimg.dtype == np.uint8:
+        lut = np.dstack(luts) if nimg.ndim == 3 else luts[0]
+        return process_tiles(nimg, lambda t: cv2.LUT(t, lut, dst=t))
+
+    def take(t):
+        if t.ndim == 2:
+            return np.take(luts[0], t, out=t, mode='clip')
+        for c in range(t.shape[2]):
+            np.take(luts[c], t[:,:,c], out=t[:,:,c], mode='clip')
+        return t
+
+    return process_tiles(nimg, take)
+
+#
+# lookup table of min(max(a * x**2 + b * x, 0), top) where x = v - shift
+#
+def poly_lut(nimg, a=0., b=1., shift=0):
+    top = np.iinfo(nimg.dtype).max
+    v = np.arange(top + 1, dtype=np.float64) - shift
+    return np.clip(a * v**2 + b * v, 0, top).astype(nimg.dtype)
+
+def hist_min(h):
+    return np.flatnonzero(h)[0]
+
+def hist_max(h):
+    return np.flatnonzero(h)[-1]
+
+def hist_sum(h, power=1):
+    return np.dot(h, np.arange(h.size, dtype=np.float64)**power)
 
 def stretch_pre(nimg):
     """
     from 'Applicability Of White-Balancing Algorithms to Restoring Faded
     Colour Slides: An Empirical Evaluation'
     """
-    nimg = nimg.transpose(2, 0, 1)
-    nimg[0] = np.maximum(nimg[0]-nimg[0].min(),0)
-    nimg[1] = np.maximum(nimg[1]-nimg[1].min(),0)
-    nimg[2] = np.maximum(nimg[2]-nimg[2].min(),0)
-
-    return nimg.transpose(1, 2, 0)
+    luts = [poly_lut(nimg, shift=hist_min(h)) for h in histograms(nimg)]
+    return apply_luts(nimg, luts)
 
 def grey_world(nimg):
-    nimg = nimg.transpose(2, 0, 1).astype(np.uint32)
-    mu_g = np.average(nimg[1])
-    nimg[0] = np.minimum(nimg[0]*(mu_g/np.average(nimg[0])),255)
-    nimg[2] = np.minimum(nimg[2]*(mu_g/np.average(nimg[2])),255)
+    hist = histograms(nimg)
+    mu = [hist_sum(h) / h.sum() for h in hist]
 
-    return  nimg.transpose(1, 2, 0).astype(np.uint8)
+    return apply_luts(nimg, [poly_lut(nimg, b=mu[1]/mu[0]),
+            poly_lut(nimg), poly_lut(nimg, b=mu[1]/mu[2])])
 
 def max_white(nimg):
-    if nimg.dtype==np.uint8:
-        brightest=float(2**8)
-    elif nimg.dtype==np.uint16:
-        brightest=float(2**16)
-    elif nimg.dtype==np.uint32:
-        brightest=float(2**32)
-    else:
-        brightest==float(2**8)
+    brightest = float(np.iinfo(nimg.dtype).max + 1)
+    luts = [poly_lut(nimg, b=brightest/max(hist_max(h), 1))
+            for h in histograms(nimg)]
 
-    nimg = nimg.transpose(2, 0, 1)
-    nimg = nimg.astype(np.int32)
-    nimg[0] = np.minimum(nimg[0] * (brightest/float(nimg[0].max())),255)
-    nimg[1] = np.minimum(nimg[1] * (brightest/float(nimg[1].max())),255)
-    nimg[2] = np.minimum(nimg[2] * (brightest/float(nimg[2].max())),255)
-
-    return nimg.transpose(1, 2, 0).astype(np.uint8)
+    return apply_luts(nimg, luts)
 
 def stretch(nimg):
-    return max_white(stretch_pre(nimg))
+    # stretch_pre and max_white in one pass
+    brightest = float(np.iinfo(nimg.dtype).max + 1)
+    luts = []
+    for h in histograms(nimg):
+        lo, hi = hist_min(h), hist_max(h)
+        gain = brightest / max(hi - lo, 1)
+        luts.append(poly_lut(nimg, b=gain, shift=lo))
+
+    return apply_luts(nimg, luts)
 
 def retinex(nimg):
-    nimg = nimg.transpose(2, 0, 1).astype(np.uint32)
-    mu_g = nimg[1].max()
-    nimg[0] = np.minimum(nimg[0]*(mu_g/float(nimg[0].max())),255)
-    nimg[2] = np.minimum(nimg[2]*(mu_g/float(nimg[2].max())),255)
+    hist = histograms(nimg)
+    mu_g = float(hist_max(hist[1]))
 
-    return nimg.transpose(1, 2, 0).astype(np.uint8)
+    return apply_luts(nimg, [poly_lut(nimg, b=mu_g/hist_max(hist[0])),
+            poly_lut(nimg), poly_lut(nimg, b=mu_g/hist_max(hist[2]))])
 
 def retinex_adjust(nimg):
     """
     from 'Combining Gray World and Retinex Theory for Automatic White
     Balance in Digital Photography'
     """
-    nimg = nimg.transpose(2, 0, 1).astype(np.uint32)
-    sum_r = np.sum(nimg[0])
-    sum_r2 = np.sum(nimg[0]**2)
-    max_r = nimg[0].max()
+    hist = histograms(nimg)
+    sum_r = hist_sum(hist[0])
+    sum_r2 = hist_sum(hist[0], 2)
+    max_r = float(hist_max(hist[0]))
     max_r2 = max_r**2
-    sum_g = np.sum(nimg[1])
-    max_g = nimg[1].max()
-    coefficient = np.linalg.solve(np.array([[sum_r2,sum_r],[max_r2,max_r]]),
+    sum_g = hist_sum(hist[1])
+    max_g = float(hist_max(hist[1]))
+    coef_r = np.linalg.solve(np.array([[sum_r2,sum_r],[max_r2,max_r]]),
             np.array([sum_g,max_g]))
 
-    nimg[0] = np.minimum((nimg[0]**2)*coefficient[0] +
-            nimg[0]*coefficient[1],255)
-    sum_b = np.sum(nimg[1])
-    sum_b2 = np.sum(nimg[1]**2)
-    max_b = nimg[1].max()
+    sum_b = hist_sum(hist[1])
+    sum_b2 = hist_sum(hist[1], 2)
+    max_b = float(hist_max(hist[1]))
     max_b2 = max_r**2
-    coefficient = np.linalg.solve(np.array([[sum_b2,sum_b],[max_b2,max_b]]),
+    coef_b = np.linalg.solve(np.array([[sum_b2,sum_b],[max_b2,max_b]]),
             np.array([sum_g,max_g]))
-    nimg[1] = np.minimum((nimg[1]**2)*coefficient[0] +
-            nimg[1]*coefficient[1],255)
 
-    return nimg.transpose(1, 2, 0).astype(np.uint8)
+    return apply_luts(nimg, [poly_lut(nimg, coef_r[0], coef_r[1]),
+            poly_lut(nimg, coef_b[0], coef_b[1]), poly_lut(nimg)])
 
 #--------1---------2---------3---------4---------5---------6---------7---------8
 # Derive rotation angle and the center coordinate from the Hough lines
@@ -203,49 +322,97 @@ def compute_rotation(lines):
     return {'centre':(cx,cy), 'angle': ang_rot,
             'size':(lx,ly), 'bb':(top,left,bottom,right)}
 
+# high threshold as a multiple of the median gradient, that of the noise
+# on the flat part of the page, within the range; the low one is half
+CANNY_NOISE_RATIO = 3.5
+CANNY_HIGH_RANGE = (40, 200)
+
+#
+# thresholds keeping the noise of the image out of the edges
+#
 def find_canny_thresholds(img):
-    global canny_low, canny_high
-    # convert PIL image to opencv image
-    cvimg = np.array(img)
+    # middle of the page at full resolution, as the edges are found
+    n = CANNY_CALIB_SIZE
+    (w,h) = img.size
+    (left,top) = (max((w - n)//2, 0), max((h - n)//2, 0))
+    gray = gray_image(img.crop((left, top, min(left + n, w),
+        min(top + n, h))))
 
-    # further convertion into gray image
-    if img.mode == 'RGB':
-        cvimg = cv2.cvtColor(cvimg, cv2.COLOR_RGB2GRAY)
+    # gradient magnitude as canny has it
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    noise = np.median(cv2.add(cv2.absdiff(gx, 0), cv2.absdiff(gy, 0)))
 
-    # high threshold first
-    canny_low = 10
-    for canny_high in range(200, 50, -10):
-        edges = cv2.Canny(cvimg, canny_low, canny_high, apertureSize=3)
+    high = int(np.clip(CANNY_NOISE_RATIO * noise, *CANNY_HIGH_RANGE) + 0.5)
 
-        if np.count_nonzero(edges) < 200:
-            break
+    return high // 2, high
 
-    # low threshold
-    for canny_low in range(10, canny_high - 20, 10):
-        edges = cv2.Canny(cvimg, canny_low, canny_high, apertureSize=3)
+#
+# canny thresholds of the scan profile, calibrated on the first image
+#
+def GetCannyThresholds(img, profile=None):
+    if profile is None:
+        return find_canny_thresholds(img)
+
+    with canny_lock:
+        if profile in canny_cache:
+            return canny_cache[profile]
 
-        if np.count_nonzero(edges) < 100:
-            break
+    # calibrated out of the lock, the first one kept
+    thresholds = find_canny_thresholds(img)
+    with canny_lock:
+        return canny_cache.setdefault(profile, thresholds)
 
 #--------1---------2---------3---------4---------5---------6---------7---------8
 #
-def AdjustWhiteBalance(img, method = 'Stretch'):
-    # convert PIL to numpy
-    arr = from_pil(img)
-    #
+def white_balance(nimg, method):
+    # a gray page has its levels stretched only, no colour to balance
+    if nimg.ndim == 2 and method not in ('Stretch', 'Max White'):
+        return nimg
+
     if method == 'Stretch':
-        arr = stretch(arr)
+        nimg = stretch(nimg)
     elif method == 'Grey World':
-        arr = grey_world(arr)
+        nimg = grey_world(nimg)
     elif method == 'Retinex':
-        arr = retinex(arr)
+        nimg = retinex(nimg)
     elif method == 'Retinex Adjust':
-        arr = retinex_adjust(arr)
+        nimg = retinex_adjust(nimg)
     elif method == 'Max White':
-        arr = max_white(arr)
+        nimg = max_white(nimg)
+
+    return nimg
+
+def AdjustWhiteBalance(img, method = 'Stretch'):
+    # convert PIL to numpy, back to PIL and return
+    return to_pil(white_balance(from_pil(img), method))
+
+#
+# find the bounding box (left, top, right, bottom) of the content on the
+# platen in pixels: None if nothing is found
+#
+def FindContentBounds(img):
+    gray = np.array(img.convert('L'))
+
+    # background level from the edges of the platen
+    border = np.concatenate((gray[0,:], gray[-1,:], gray[:,0], gray[:,-1]))
+    bgnd = np.uint8(np.median(border))
+
+    # anything different enough from the background
+    diff = cv2.absdiff(gray, np.full_like(gray, bgnd))
+    mask = np.uint8(diff > CONTENT_THOLD)
+    # remove dust and noise
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((3,3), np.uint8))
+
+    pts = cv2.findNonZero(mask)
+    if pts is None:
+        return None
+
+    x, y, w, h = cv2.boundingRect(pts)
+    if w * h > CONTENT_MAX_RATIO * gray.shape[0] * gray.shape[1]:
+        return None
 
-    # back to PIL and return
-    return to_pil(arr)
+    return (x, y, x + w, y + h)
 
 #
 # apply calibration to the image
@@ -262,132 +429,1068 @@ def ApplyCalibration(img, caltype):
         return img.copy()
 
 #
+# calibration on the page buffer: nothing to apply yet either
 #
-#
-def GetRectifiedImage(img):
-    # convert PIL image to opencv image
-    cvimg = np.array(img)
-
-    # further convertion into gray image
-    if img.mode == 'RGB':
-        cvimg = cv2.cvtColor(cvimg, cv2.COLOR_RGB2GRAY)
+def apply_calibration(nimg, caltype):
+    return nimg
 
-    # canny edge
-    edges = cv2.Canny(cvimg, canny_low, canny_high, apertureSize=3)
+#--------1---------2---------3---------4---------5---------6---------7---------8
+# Rectification on an image pyramid: the geometry is estimated on a reduced
+# copy, then refined at full resolution in bands around the document edges.
+# On the reduced copy the minimum area rectangle of the largest contour is
+# tried first, the hough lines only when the rectangle is not on the edges.
+# At full resolution the sides are fitted to the canny edges along them.
+# Each result is checked against the page and the coarse estimate, which
+# is kept when the refinement fails.
+#
+# angles searched around the coarse estimate
+REFINE_RAD = np.radians(1)
+# half width of the bands in pixels of the reduced copy
+REFINE_BAND = 12
+# points checked along each side of the rectangle
+RECT_SAMPLES = 64
+# distance in pixels of a point from the edges to be on them
+RECT_TOL = 2
+# fraction of the points on the edges for the rectangle to be accepted
+RECT_SUPPORT = 0.95
+
+# detections by tier: sides fitted at full resolution, hough lines near the
+# coarse estimate, coarse estimate only, whole image at full resolution,
+# nothing found
+rect_stats = {'rect':0, 'hough':0, 'coarse':0, 'full':0, 'none':0}
 
+#
+# outer contours of the canny edges and their drawing on a blank image
+#
+def contour_edges(edges):
     # dilate
-    edges = cv2.dilate(edges, np.ones((3,3), np.int8))
+    edges = cv2.dilate(edges, np.ones((3,3), np.uint8))
     # then find contours
-    edges, contours, hr = cv2.findContours(edges, cv2.RETR_EXTERNAL,
-            cv2.CHAIN_APPROX_SIMPLE)
+    # (the image is not returned first any more since opencv 4)
+    contours = cv2.findContours(edges, cv2.RETR_EXTERNAL,
+            cv2.CHAIN_APPROX_SIMPLE)[-2]
     # draw the contour on the blank background
     blank = np.zeros_like(edges)
     cv2.drawContours(blank, contours, -1, (255,255,255), 1)
 
-    # Hough lines probabilistic
+    return blank, contours
+
+#
+# geometry of the rotated rectangle of opencv, the angle within +-45
+# degrees as compute_rotation has it
+#
+def rect_geometry(rect, scale=1):
+    ((cx,cy), (lx,ly), deg) = rect
+    ang = np.radians(deg)
+    while ang > RAD_45:
+        ang, lx, ly = ang - RAD_90, ly, lx
+    while ang <= -RAD_45:
+        ang, lx, ly = ang + RAD_90, ly, lx
+
+    # in pixels of the full size image
+    box = cv2.boxPoints(rect) * scale
+    (cx,cy), (lx,ly) = (cx * scale, cy * scale), (lx * scale, ly * scale)
+
+    return {'centre':(cx,cy), 'angle': ang, 'size':(lx,ly),
+            'bb':(box[:,1].min(), box[:,0].min(),
+                box[:,1].max(), box[:,0].max())}
+
+#
+# corners of the document
+#
+def rot_corners(rot):
+    (cx,cy) = rot['centre']
+    (lx,ly) = rot['size']
+    c, s = np.cos(rot['angle']), np.sin(rot['angle'])
+
+    return np.float32([(cx + c*x - s*y, cy + s*x + c*y) for (x,y) in
+            ((-lx/2,-ly/2), (lx/2,-ly/2), (lx/2,ly/2), (-lx/2,ly/2))])
+
+#
+# fraction of the points along the sides of the box with an edge pixel
+# within the tolerance
+#
+def side_support(edges, box):
+    t = np.linspace(0, 1, RECT_SAMPLES, endpoint=False)[:,None]
+    pts = np.concatenate([box[k] + t * (box[(k+1) % 4] - box[k])
+        for k in range(4)])
+    x = np.rint(pts[:,0]).astype(int)
+    y = np.rint(pts[:,1]).astype(int)
+    # any edge pixel in the neighbourhood
+    (h,w) = edges.shape
+    off = np.arange(-RECT_TOL, RECT_TOL + 1)
+    near = edges[np.clip(y[:,None,None] + off[None,:,None], 0, h - 1),
+            np.clip(x[:,None,None] + off[None,None,:], 0, w - 1)]
+    on = near.any(axis=(1,2)) & (x >= 0) & (x < w) & (y >= 0) & (y < h)
+
+    return np.mean(on)
+
+#
+# rotation from the minimum area rectangle of the largest contour, if its
+# sides are on the edges
+#
+def rect_rotation(blank, contours, scale=1):
+    if len(contours) == 0:
+        return None
+
+    rect = cv2.minAreaRect(max(contours, key=cv2.contourArea))
+    if side_support(blank, cv2.boxPoints(rect)) < RECT_SUPPORT:
+        return None
+
+    return rect_geometry(rect, scale)
+
+#
+# rotation from the sides of the geometry fitted to the edge pixels within
+# the band along them, if the fitted sides are on the edges
+#
+def fit_rotation(edges, rot, band):
+    (ys,xs) = np.nonzero(edges)
+    pts = np.float32(np.column_stack((xs,ys)))
+    corners = rot_corners(rot)
+
+    lines = []
+    for k in range(4):
+        p0, p1 = corners[k], corners[(k+1) % 4]
+        length = np.hypot(*(p1 - p0))
+        d = (p1 - p0) / length
+        # position along the side and distance across it
+        along = (pts - p0) @ d
+        across = (pts - p0) @ np.float32((-d[1], d[0]))
+        near = (np.abs(across) < band) & (along > 0) & (along < length)
+        (side, across) = (pts[near], across[near])
+        if len(side) < RECT_SAMPLES:
+            return None
+
+        # the edge is where most of the pixels are across the side, the
+        # line fitted through it then to the pixels on it
+        hist = np.bincount(np.int32(across + band), minlength=2*band + 1)
+        win = np.ones(4*RECT_TOL + 1)
+        peak = np.argmax(np.convolve(hist, win, 'same')) - band
+        line = cv2.fitLine(side[np.abs(across - peak) <= 2*RECT_TOL],
+                cv2.DIST_HUBER, 0, 0.01, 0.01).ravel()
+        dist = np.abs((side[:,0] - line[2]) * line[1] -
+                (side[:,1] - line[3]) * line[0])
+        if np.count_nonzero(dist <= RECT_TOL) < RECT_SAMPLES:
+            return None
+        lines.append(cv2.fitLine(side[dist <= RECT_TOL], cv2.DIST_L2, 0,
+                0.01, 0.01).ravel())
+
+    # corners where the sides meet
+    box = []
+    for k in range(4):
+        (vx0,vy0,x0,y0), (vx1,vy1,x1,y1) = lines[k - 1], lines[k]
+        den = vx0 * vy1 - vy0 * vx1
+        if abs(den) < 1e-6:
+            return None
+        t = ((x1 - x0) * vy1 - (y1 - y0) * vx1) / den
+        box.append((x0 + t * vx0, y0 + t * vy0))
+    box = np.float32(box)
+
+    if side_support(edges, box) < RECT_SUPPORT:
+        return None
+
+    return rect_geometry(cv2.minAreaRect(box))
+
+#
+# the geometry is of a document within the page, near the coarse estimate
+# if there is one: the angle within the search and the sides within the
+# band
+#
+def valid_rotation(rot, size, coarse=None, band=0):
+    if rot is None:
+        return False
+
+    (t,l,b,r) = rot['bb']
+    (w,h) = size
+    if l < -RECT_TOL or t < -RECT_TOL or r > w + RECT_TOL or \
+            b > h + RECT_TOL:
+        return False
+    # as short as the hough lines would miss is no document
+    if min(rot['size']) < HOUGH_THLIST[-1]:
+        return False
+
+    if coarse is None:
+        return True
+
+    dang = (rot['angle'] - coarse['angle'] + RAD_45) % RAD_90 - RAD_45
+    dcen = np.hypot(rot['centre'][0] - coarse['centre'][0],
+            rot['centre'][1] - coarse['centre'][1])
+    dsize = np.subtract(sorted(rot['size']), sorted(coarse['size']))
+
+    return abs(dang) <= REFINE_RAD and dcen <= band and \
+            np.abs(dsize).max() <= 2*band
+
+#
+# rotation from the hough lines in the angle windows, the threshold lowered
+# until the lines are found
+#
+def hough_rotation(blank, theta, windows, scale=1):
     for thold in HOUGH_THLIST:
-        lines = cv2.HoughLines(blank, 1, np.pi/720, thold)
+        lines = [cv2.HoughLines(blank, 1, theta, max(int(thold / scale), 1),
+                min_theta=a, max_theta=b) for (a,b) in windows]
+        lines = [x for x in lines if x is not None]
+        if len(lines) == 0:
+            continue
+
+        lines = np.concatenate(lines)
+        # in pixels of the full size image
+        lines[:,0,0] *= scale
+        # angles as counted from 0 whatever the window
+        lines[:,0,1] = np.float32(theta) * np.round(lines[:,0,1] / theta)
         rot = compute_rotation(lines)
 
         if rot is not None:
-            break
+            return rot
 
-    if rot is None:
-        # do nothing and just return
-        return None, (0,0)
+    return None
 
-    # bounding box, angle, size, centre
-    (t,l,b,r) = rot['bb']
-    ang = math.degrees(rot['angle'])
+#
+# angle windows within [0, pi] around the direction, on the grid of the
+# angle resolution
+#
+def angle_windows(ang, delta, theta):
+    windows = []
+
+    # pi is the same line as 0
+    end = np.pi - theta
+
+    for a in (ang % np.pi, (ang + RAD_90) % np.pi):
+        a = round(a / theta) * theta
+        if a - delta < 0:
+            windows += [(0., a + delta), (a - delta + np.pi, end)]
+        elif a + delta > end:
+            windows += [(a - delta, end), (0., a + delta - np.pi)]
+        else:
+            windows.append((a - delta, a + delta))
+
+    return windows
+
+#
+# gray opencv image of the PIL image
+#
+def gray_image(img):
+    cvimg = np.asarray(img)
+
+    if img.mode == 'RGB':
+        cvimg = cv2.cvtColor(cvimg, cv2.COLOR_RGB2GRAY)
+
+    return cvimg
+
+#
+# canny edges at full resolution near the sides of the coarse geometry only
+#
+def band_edges(img, rot, low, high, factor):
+    corners = rot_corners(rot)
+
+    band = REFINE_BAND * factor
+    (w,h) = img.size
+    edges = np.zeros((h,w), np.uint8)
+
+    # canny edges in a strip along each side
+    for k in range(4):
+        (x0,y0), (x1,y1) = corners[k], corners[(k+1) % 4]
+        left = max(int(min(x0, x1)) - band, 0)
+        top = max(int(min(y0, y1)) - band, 0)
+        right = min(int(max(x0, x1)) + band + 1, w)
+        bottom = min(int(max(y0, y1)) + band + 1, h)
+        if right <= left or bottom <= top:
+            return None
+
+        strip = gray_image(img.crop((left, top, right, bottom)))
+        strip = cv2.Canny(strip, low, high, apertureSize=3)
+        roi = edges[top:bottom, left:right]
+        np.maximum(roi, strip, out=roi)
+
+    return edges
+
+#
+# refined geometry near the coarse one: the sides fitted to the edges or
+# the hough lines near its angle, None if neither holds
+#
+def refine_rotation(img, coarse, low, high, factor):
+    band = REFINE_BAND * factor
+    edges = band_edges(img, coarse, low, high, factor)
+    if edges is None:
+        return None, None
+
+    rot = fit_rotation(edges, coarse, band)
+    if valid_rotation(rot, img.size, coarse, band):
+        return rot, 'rect'
+
+    rot = hough_rotation(contour_edges(edges)[0], np.pi/720,
+            angle_windows(coarse['angle'], REFINE_RAD, np.pi/720))
+    if valid_rotation(rot, img.size, coarse, band):
+        return rot, 'hough'
+
+    return None, None
+
+#
+# geometry on the whole image at full resolution: the sides of the largest
+# contour fitted to the edges, or the hough lines
+#
+def full_rotation(img, low, high):
+    edges = cv2.Canny(gray_image(img), low, high, apertureSize=3)
+    blank, contours = contour_edges(edges)
+
+    if len(contours) > 0:
+        rect = cv2.minAreaRect(max(contours, key=cv2.contourArea))
+        band = REFINE_BAND * max(int(math.ceil(max(img.size) /
+                RECT_COARSE_SIZE)), 1)
+        rot = fit_rotation(edges, rect_geometry(rect), band)
+        if valid_rotation(rot, img.size):
+            return rot
+
+    rot = hough_rotation(blank, np.pi/720, [(0., np.pi)])
+
+    return rot if valid_rotation(rot, img.size) else None
+
+#
+# angle, centre, size and bounding box of the document
+#
+def GetRotation(img, profile=None):
+    low, high = GetCannyThresholds(img, profile)
+
+    # coarse estimate on a reduced copy
+    factor = max(int(math.ceil(max(img.size) / RECT_COARSE_SIZE)), 1)
+    if factor > 1:
+        blank, contours = contour_edges(cv2.Canny(
+            gray_image(img.reduce(factor)), low, high, apertureSize=3))
+        coarse = rect_rotation(blank, contours, factor)
+
+        # refined at full resolution near the sides, the rectangle on its
+        # edges kept if that fails
+        if valid_rotation(coarse, img.size):
+            rot, tier = refine_rotation(img, coarse, low, high, factor)
+            if rot is None:
+                rot, tier = coarse, 'coarse'
+            rect_stats[tier] += 1
+            return rot
+
+        # the hough lines are not checked on the edges: only refined
+        coarse = hough_rotation(blank, np.pi/180, [(0., np.pi)], factor)
+        if valid_rotation(coarse, img.size):
+            rot, tier = refine_rotation(img, coarse, low, high, factor)
+            if rot is not None:
+                rect_stats[tier] += 1
+                return rot
+
+    # whole image at full resolution
+    rot = full_rotation(img, low, high)
+    rect_stats['full' if rot is not None else 'none'] += 1
+
+    return rot
+
+#
+# share of the detections by tier
+#
+def GetRectStats():
+    total = max(sum(rect_stats.values()), 1)
+
+    return dict((k, v / total) for (k,v) in rect_stats.items())
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+# resampling of the warp
+INTERPOLATION = {
+        'Nearest':cv2.INTER_NEAREST,
+        'Bilinear':cv2.INTER_LINEAR,
+        'Bicubic':cv2.INTER_CUBIC,
+        'Lanczos':cv2.INTER_LANCZOS4,
+        }
+# source pixels kept around the document for the interpolation
+WARP_MARGIN = 4
+
+#
+# size of the rectified document
+#
+def document_size(rot):
     (w,h) = rot['size']
+
+    return int(w + 0.5), int(h + 0.5)
+
+#
+# source pixels of the document (left, top, right, bottom), with a margin
+# for the interpolation
+#
+def source_box(rot, size):
+    (t,l,b,r) = rot['bb']
+
+    return (max(int(l) - WARP_MARGIN, 0), max(int(t) - WARP_MARGIN, 0),
+            min(int(r) + WARP_MARGIN + 1, size[0]),
+            min(int(b) + WARP_MARGIN + 1, size[1]))
+
+#
+# warp the document straight from the source pixels at the origin into
+# the canvas at the offset
+#
+def warp_document(src, origin, rot, canvas, offset, quality=RECT_QUALITY):
+    (w,h) = document_size(rot)
+    (dx,dy) = offset
+
+    # part of the canvas covered by the document
+    left, top = max(dx, 0), max(dy, 0)
+    right = min(dx + w, canvas.shape[1])
+    bottom = min(dy + h, canvas.shape[0])
+    if right <= left or bottom <= top:
+        return
+
+    # canvas pixel to the source: rotation of the offset from the centre
     (cx,cy) = rot['centre']
+    c, s = np.cos(rot['angle']), np.sin(rot['angle'])
+    ox = left - dx - (w - 1) / 2.
+    oy = top - dy - (h - 1) / 2.
+    mat = np.array([
+        [c, -s, cx + c * ox - s * oy - origin[0]],
+        [s, c, cy + s * ox + c * oy - origin[1]]])
+
+    white = (255,) * canvas.shape[2] if canvas.ndim == 3 else 255
+    cv2.warpAffine(src, mat, (right - left, bottom - top),
+            dst=canvas[top:bottom, left:right],
+            flags=INTERPOLATION[quality] | cv2.WARP_INVERSE_MAP,
+            borderMode=cv2.BORDER_CONSTANT, borderValue=white)
 
-    # crop
-    crop = img.crop((int(l+0.5),int(t+0.5),int(r+0.5),int(b+0.5)))
-    # rotate
-    crop = crop.rotate(ang, expand=1, resample = Image.BICUBIC)
-    # crop again
-    dx = (crop.size[0] - w)/2.
-    dy = (crop.size[1] - h)/2.
-    crop = crop.crop((int(dx+0.5),int(dy+0.5),
-            int(crop.size[0]-dx+0.5),int(crop.size[1]-dy+0.5)))
-
-    return crop, (cx,cy)
-
-def AdjustColorBalance(img, cb):
-    return ImageEnhance.Color(img).enhance(cb)
-
-def AdjustContrast(img, ct):
-    return ImageEnhance.Contrast(img).enhance(ct)
-
-def AdjustBrightness(img, br):
-    return ImageEnhance.Brightness(img).enhance(br)
-
-def AdjustSharpness(img, sn):
-    return ImageEnhance.Sharpness(img).enhance(sn)
-
-#
-# apply filter on the image
-# be sure not to change the original image
-#
-def ApplyFilter(img, sh):
-    if sh == 'Blur':
-        return img.filter(ImageFilter.BLUR)
-    elif sh == 'Contour':
-        return img.filter(ImageFilter.CONTOUR)
-    elif sh == 'Detail':
-        return img.filter(ImageFilter.DETAIL)
-    elif sh == 'Edge Enhance':
-        return img.filter(ImageFilter.EDGE_ENHANCE)
-    elif sh == 'Emboss':
-        return img.filter(ImageFilter.EMBOSS)
-    elif sh == 'Smooth':
-        return img.filter(ImageFilter.SMOOTH)
-    elif sh == 'Unsharpen':
-        return img.filter(ImageFilter.SHARPEN)
-    elif sh == 'Anti-Halftone':
-        return img.filter(ImageFilter.GaussianBlur(GB_RADIUS)).filter(
-                ImageFilter.UnsharpMask(UM_RADIUS, UM_PERCENT, UM_THOLD))
+#
+# white canvas of the size, RGB or gray
+#
+def white_canvas(size, rgb=True):
+    if rgb:
+        return np.full((size[1], size[0], 3), 255, np.uint8)
     else:
-        return img.copy()
+        return np.full((size[1], size[0]), 255, np.uint8)
 
 #
-# Draw watermark string
+# position of the document centred on the page, 'Horizontal', 'Vertical'
+# or 'Both'
 #
-def ApplyWatermark(img, wm):
-    # check font file
-    ttflist = glob.glob(FONT_DIR + '*.ttf')
-    if len(ttflist) == 0:
-        wx.MessageBox("No font file found in the resource folder.\n" +
-                "Copy a font file (*.ttf) into the folder ({}).".format(
-                 FONT_DIR))
-        return img
+def center_offset(rot, size, mode):
+    # find the coodinate for the rectified image
+    (w,h) = document_size(rot)
+    (cx,cy) = rot['centre']
+    if mode == 'Horizontal':
+        dx = int((size[0] - w)/2 + 0.5)
+        dy = int(cy - h/2 + 0.5)
+    elif mode == 'Vertical':
+        dx = int(cx - w/2 + 0.5)
+        dy = int((size[1] - h)/2 + 0.5)
     else:
-        # font
-        fnt = ImageFont.truetype(FONT_DIR + ttflist[0], WATERMARK_PNT)
-
-    # change image format
-    img = img.convert(mode='RGBA')
-    rw,rh = img.size
-    # blank image with enough size
-    txt = Image.new('RGBA', (rh,rw), (255,255,255,0))
-    # drawing context
-    dc = ImageDraw.Draw(txt)
+        dx = int((size[0] - w)/2 + 0.5)
+        dy = int((size[1] - h)/2 + 0.5)
+
+    return dx, dy
+
+#
+# rotation of the document of the page buffer, found on the gray page
+#
+def buffer_rotation(nimg, profile=None):
+    gray = nimg if nimg.ndim == 2 else cv2.cvtColor(nimg, cv2.COLOR_RGB2GRAY)
+
+    return GetRotation(to_pil(gray), profile)
+
+#
+# document of the page buffer warped straight into a white one of the size
+# at the offset
+#
+def rectify_buffer(nimg, rot, size, offset, quality=RECT_QUALITY):
+    canvas = white_canvas(size, nimg.ndim == 3)
+    (l,t,r,b) = source_box(rot, (nimg.shape[1], nimg.shape[0]))
+    warp_document(nimg[t:b, l:r], (l,t), rot, canvas, offset, quality)
+
+    return canvas
+
+#
+# the document alone and its centre on the page: None if not found
+#
+def GetRectifiedImage(img, profile=None, quality=RECT_QUALITY):
+    nimg = page_buffer(img)
+    rot = buffer_rotation(nimg, profile)
+
+    if rot is None:
+        # do nothing and just return
+        return None, (0,0)
+
+    return (to_pil(rectify_buffer(nimg, rot, document_size(rot), (0,0),
+        quality)), rot['centre'])
+
+#
+# centre the document of the page buffer on a new white one, 'Horizontal',
+# 'Vertical' or 'Both'
+#
+def center_buffer(nimg, mode, profile=None, quality=RECT_QUALITY):
+    rot = buffer_rotation(nimg, profile)
+
+    if rot is None:
+        return nimg
+
+    size = (nimg.shape[1], nimg.shape[0])
+    return rectify_buffer(nimg, rot, size, center_offset(rot, size, mode),
+            quality)
+
+# weights of PIL convert('L') in 16 bits fixed point
+LUMA_FIXED = np.float32([[19595, 38470, 7471]])
+
+#
+# grey level of the RGB buffer, or of its single precision copy, in the fixed
+# point of PIL convert('L'): exact in single precision, below 2**24
+#
+def luma(nimg):
+    if nimg.ndim == 2:
+        return nimg
+
+    lum = cv2.transform(nimg.astype(np.float32, copy=False), LUMA_FIXED)
+    return np.floor((lum + np.float32(0x8000)) * np.float32(2**-16))
+
+#
+# contrast and brightness lookup table, in single precision as PIL blend
+#
+def tone_lut(ct, br, mean):
+    lut = np.arange(256, dtype=np.float32)
+    # contrast: blend with the mean grey level
+    if ct != 1.0:
+        mean = np.float32(mean)
+        lut = np.floor(np.clip(mean + np.float32(ct) * (lut - mean), 0, 255))
+    # brightness: blend with black
+    if br != 1.0:
+        lut = np.clip(np.float32(br) * lut, 0, 255)
+
+    return lut.astype(np.uint8)
+
+#
+# colour balance, contrast and brightness as ImageEnhance does them but in
+# the page buffer, in a pass by tiles: the colour blended with the grey in
+# single precision and truncated as PIL blend does, then the grey levels of
+# the result counted for the contrast, which needs a second pass for its
+# lookup table with the brightness
+#
+def tone(nimg, cb=1.0, ct=1.0, br=1.0):
+    colour = cb != 1.0 and nimg.ndim == 3
+    lut = tone_lut(1.0, br, 0) if ct == 1.0 and br != 1.0 else None
+    hists = []
+
+    def balance(t):
+        res = t
+        if colour:
+            # blended in place on a copy and truncated to the levels
+            res = np.float32(t)
+            gray = cv2.cvtColor(luma(res), cv2.COLOR_GRAY2RGB)
+            res -= gray
+            res *= np.float32(cb)
+            res += gray
+            np.floor(np.clip(res, 0, 255, out=res), out=res)
+            t[:] = res
+        if ct != 1.0:
+            hists.append(np.bincount(np.uint8(luma(res)).ravel(),
+                minlength=256))
+        elif lut is not None:
+            cv2.LUT(t, lut, dst=t)
+        return t
+
+    if colour or lut is not None or ct != 1.0:
+        process_tiles(nimg, balance)
+
+    if ct != 1.0:
+        hist = np.sum(hists, axis=0)
+        lut = tone_lut(ct, br, int(hist_sum(hist) / hist.sum() + 0.5))
+        process_tiles(nimg, lambda t: cv2.LUT(t, lut, dst=t))
+
+    return nimg
+
+#
+# sharpness by tiles: blend with the smoothed image
+#
+def sharpness(nimg, sn):
+    return process_tiles(nimg, lambda t: np.asarray(
+        ImageEnhance.Sharpness(Image.fromarray(t)).enhance(sn)), 2)
+
+FILTERS = {
+        'Blur':ImageFilter.BLUR,
+        'Contour':ImageFilter.CONTOUR,
+        'Detail':ImageFilter.DETAIL,
+        'Edge Enhance':ImageFilter.EDGE_ENHANCE,
+        'Emboss':ImageFilter.EMBOSS,
+        'Smooth':ImageFilter.SMOOTH,
+        'Unsharpen':ImageFilter.SHARPEN,
+        }
+# rows the filters reach around a pixel
+FILTER_HALO = 2
+
+#
+# filter of the page buffer by tiles with their halo
+#
+def apply_filter(nimg, sh):
+    if sh == 'Anti-Halftone':
+        return descreen(nimg, find_screen(nimg))
+    elif sh not in FILTERS:
+        return nimg
+
+    return process_tiles(nimg, lambda t: np.asarray(
+        Image.fromarray(t).filter(FILTERS[sh])), FILTER_HALO)
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+# Descreening: the halftone screen shows as sharp peaks in the spectrum of
+# the page, at its frequencies, their harmonics and their aliases. They are
+# found on a tile in the middle of the page, for each page as the screen is
+# that of the original, and notched out of the spectrum of each tile.
+#
+def find_screen(nimg):
+    gray = nimg if nimg.ndim == 2 else cv2.cvtColor(nimg, cv2.COLOR_RGB2GRAY)
+
+    # tile in the middle, windowed against the edges
+    (h,w) = gray.shape
+    n = min(DESCREEN_SIZE, h, w)
+    tile = np.float32(gray[(h-n)//2:(h-n)//2+n, (w-n)//2:(w-n)//2+n])
+    tile = (tile - tile.mean()) * np.outer(np.hanning(n), np.hanning(n))
+
+    # log spectrum above the spectrum around
+    spec = np.log1p(np.abs(np.fft.fftshift(np.fft.fft2(tile))))
+    spec = np.float32(spec)
+    spec = spec - cv2.GaussianBlur(spec, (0,0), 4)
+
+    # local maxima away from the content at the low frequencies
+    freq = np.fft.fftshift(np.fft.fftfreq(n))
+    fx, fy = np.meshgrid(freq, freq)
+    peaks = ((spec == cv2.dilate(spec, np.ones((5,5), np.uint8)))
+            & (spec > DESCREEN_PROMINENCE)
+            & (np.hypot(fx, fy) > DESCREEN_MIN_FREQ)
+            # one of the conjugate pair
+            & ((fy > 0) | ((fy == 0) & (fx > 0))))
+
+    # the strongest ones
+    (ys,xs) = np.nonzero(peaks)
+    order = np.argsort(spec[ys,xs])[::-1][:DESCREEN_PEAKS]
+    found = np.array([screen_peak(spec, y, x, freq)
+            for (y,x) in zip(ys[order], xs[order])]).reshape(-1, 2)
+
+    return tuple(map(tuple, found[screen_lattice(found)]))
+
+#
+# The peaks of a screen lie on a lattice of two frequencies across each
+# other: a peak is of the screen if it is the sum of two peaks across each
+# other, aliased, within a notch. Lines of text, or any pattern of one
+# direction, give peaks along a line only.
+#
+SCREEN_ACROSS = np.sin(np.radians(10))
+
+def screen_lattice(found):
+    # the peaks and their conjugates
+    both = np.concatenate((found, -found))
+    (a,b) = (both[:,None], both[None,:])
+    norm = np.hypot(both[:,0], both[:,1])
+
+    # sums of the pairs across each other, aliased
+    cross = np.abs(a[...,0] * b[...,1] - a[...,1] * b[...,0])
+    sums = (a + b)[cross > SCREEN_ACROSS * np.outer(norm, norm)]
+
+    dist = np.abs((sums[None] - found[:,None] + 0.5) % 1 - 0.5).max(axis=-1)
+
+    return np.any(dist < DESCREEN_NOTCH, axis=1)
+
+#
+# frequency of the peak between the bins
+#
+def screen_peak(spec, y, x, freq):
+    def vertex(a, b, c):
+        den = a - 2*b + c
+        return 0.5 * (a - c) / den if den < 0 else 0.
+
+    n = len(freq)
+    dx = vertex(spec[y, x-1], spec[y, x], spec[y, (x+1) % n])
+    dy = vertex(spec[y-1, x], spec[y, x], spec[(y+1) % n, x])
+
+    return (float(freq[x] + dx / n), float(freq[y] + dy / n))
+
+#
+# notch filter of the screen for the spectrum of the shape, packed as the
+# real spectrum of OpenCV (CCS) for mulSpectrums
+#
+def screen_notches(screen, shape):
+    fy = np.fft.fftfreq(shape[0])
+    fx = np.fft.fftfreq(shape[1])
+    mask = np.ones(shape, np.float32)
+
+    # gaussian notches on the peaks and their conjugates, separable and
+    # only where they reach
+    for (px,py) in screen + tuple((-px,-py) for (px,py) in screen):
+        gy = np.exp(-((fy - py + 0.5) % 1 - 0.5)**2 / (2 * DESCREEN_NOTCH**2))
+        gx = np.exp(-((fx - px + 0.5) % 1 - 0.5)**2 / (2 * DESCREEN_NOTCH**2))
+        (iy,ix) = (np.nonzero(gy > 1e-4)[0], np.nonzero(gx > 1e-4)[0])
+        mask[np.ix_(iy,ix)] *= np.float32(1 - np.outer(gy[iy], gx[ix]))
+
+    # symmetric so that its kernel is real
+    return cv2.dft(np.float32(np.fft.ifft2(mask).real))
+
+#
+# notch out the screen by tiles in the frequency domain
+#
+def descreen(nimg, screen):
+    if len(screen) == 0:
+        return nimg
+
+    # reach of the notches in the pixels, reflected at the edges
+    halo = int(3 / (2 * np.pi * DESCREEN_NOTCH)) + 1
+    masks = {}
+
+    def notch(tile):
+        (h,w) = tile.shape[:2]
+        shape = (cv2.getOptimalDFTSize(h), cv2.getOptimalDFTSize(w + 2*halo))
+        if shape not in masks:
+            masks[shape] = screen_notches(screen, shape)
+
+        # the halo rows are there, the columns reflected
+        pad = cv2.copyMakeBorder(np.float32(tile), 0, shape[0] - h,
+                halo, shape[1] - w - halo, cv2.BORDER_REFLECT)
+        planes = list(cv2.split(pad))
+        for i, plane in enumerate(planes):
+            spec = cv2.mulSpectrums(cv2.dft(plane), masks[shape], 0)
+            planes[i] = cv2.idft(spec, flags=cv2.DFT_REAL_OUTPUT|cv2.DFT_SCALE)
+
+        res = cv2.merge(planes)[:h, halo:halo + w]
+        return np.uint8(np.clip(res + 0.5, 0, 255))
+
+    return process_tiles(nimg, notch, halo, True)
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+# Layers blended on the page: kept premultiplied by their alpha with the
+# inverse alpha, so that blending is one multiply and one add. The inverse
+# alpha is kept a byte a pixel and the colour not at all when black
+#
+def MakeLayer(rgba):
+    alpha = rgba.getchannel('A')
+    box = alpha.getbbox()
+
+    if box is None:
+        # fully transparent
+        return None
+
+    rgba = np.asarray(rgba.crop(box))
+    alpha = rgba[:,:,3]
+    if rgba[:,:,:3].any():
+        premul = cv2.merge([cv2.multiply(rgba[:,:,c], alpha, scale=1/255.)
+            for c in range(3)])
+    else:
+        premul = None
+
+    return {'box':box, 'premul':premul, 'inv':255 - alpha}
+
+#
+# bytes of the layer
+#
+def layer_size(layer):
+    if layer is None:
+        return 0
+
+    premul = layer['premul']
+    return layer['inv'].nbytes + (0 if premul is None else premul.nbytes)
+
+#
+# blend the layer on the page buffer in place, made RGB first: the inverse
+# alpha is made RGB a band of rows at a time
+#
+def blend_layer(nimg, layer):
+    nimg = rgb_buffer(nimg)
+
+    if layer is not None:
+        (l,t,r,b) = layer['box']
+        rows = TILE_ROWS if TILE_ROWS > 0 else b - t
+        for y in range(0, b - t, rows):
+            roi = nimg[t + y:min(t + y + rows, b), l:r]
+            inv = cv2.cvtColor(layer['inv'][y:y + rows], cv2.COLOR_GRAY2RGB)
+            roi[:] = cv2.multiply(roi, inv, scale=1/255.)
+            if layer['premul'] is not None:
+                roi[:] = cv2.add(roi, layer['premul'][y:y + rows])
+
+    return nimg
+
+#
+# layer of the key, rendered only if not in the cache: the least recently
+# used dropped first, what it is made of kept with it so that ids are not
+# reused while cached
+#
+def cached_layer(key, render, refs=None):
+    global layer_bytes
+
+    with layer_lock:
+        if key in layer_cache:
+            layer_cache.move_to_end(key)
+            return layer_cache[key][1]
+
+    # rendered out of the lock, the first one kept
+    layer = render()
+    size = layer_size(layer)
+    if size > LAYER_CACHE_BYTES:
+        return layer
+
+    with layer_lock:
+        if key in layer_cache:
+            return layer_cache[key][1]
+        layer_cache[key] = (refs, layer)
+        layer_bytes = layer_bytes + size
+
+        while layer_bytes > LAYER_CACHE_BYTES:
+            refs, old = layer_cache.popitem(last=False)[1]
+            layer_bytes = layer_bytes - layer_size(old)
+
+    return layer
+
+#
+# watermark string rendered over the page size
+#
+def render_watermark(wm, font, size, opacity):
+    fnt = ImageFont.truetype(font, WATERMARK_PNT)
+
+    rw,rh = size
+    # text size
+    dc = ImageDraw.Draw(Image.new('RGBA', (1,1)))
+    (l,t,r,b) = dc.textbbox((10,10), wm, font=fnt)
+    # blank image with just enough size
+    txt = Image.new('RGBA', (r+10,b+10), (255,255,255,0))
     # draw text with opacity
-    dc.text((10,10), wm, font=fnt, fill=(0,0,0,WATERMARK_OPQ))
-    # get text size
-    txw, txh = dc.textsize(wm, font=fnt)
-    # crop
-    crop = txt.crop((0,0,txw+20,txh+20))
+    ImageDraw.Draw(txt).text((10,10), wm, font=fnt, fill=(0,0,0,opacity))
     # rotate
-    rot = crop.rotate(math.degrees(math.tan(rw/float(rh))), expand=1,
+    rot = txt.rotate(math.degrees(math.tan(rw/float(rh))), expand=1,
         resample = Image.BICUBIC)
     # resize
-    txt = rot.resize(img.size, resample = Image.BICUBIC)
-    # alpha channel composite
-    img = Image.alpha_composite(img,txt)
-    # drop alpha channel and return
-    return img.convert(mode='RGB')
+    return MakeLayer(rot.resize(size, resample = Image.BICUBIC))
+
+#
+# font file of the watermark, None if there is none
+#
+def GetWatermarkFont():
+    ttflist = sorted(glob.glob(FONT_DIR + '*.ttf'))
+
+    return ttflist[0] if len(ttflist) > 0 else None
+
+#
+# watermark layer for the page size, None without a font
+#
+def WatermarkLayer(wm, size):
+    font = GetWatermarkFont()
+    if font is None:
+        return None
+
+    # rendered once for the page size
+    return cached_layer(('wm', wm, font, size, WATERMARK_OPQ),
+            lambda: render_watermark(wm, font, size, WATERMARK_OPQ))
+
+#
+# background layer for the page size
+#
+def BackgroundLayer(bgnd, size):
+    # resized once per page size
+    return cached_layer(('bk', id(bgnd), size),
+            lambda: MakeLayer(bgnd.convert('RGBA').resize(size)), bgnd)
+
+#
+# background image made transparent where it is white enough
+#
+def KeyBackground(img):
+    arr = np.array(img.convert('RGBA'))
+
+    # all of the colour channels above the threshold
+    white = cv2.inRange(arr[:,:,:3], (ALPHA_THOLD + 1,) * 3, (255,) * 3)
+    alpha = arr[:,:,3]
+    alpha[:] = ALPHA_FGND
+    alpha[white > 0] = ALPHA_BGND
+
+    return Image.fromarray(arr, 'RGBA')
+
+#
+# file of the keyed background in the cache: the source file and its
+# modification time with the keying parameters
+#
+def keyed_file(fpath):
+    try:
+        mtime = os.path.getmtime(fpath)
+    except OSError:
+        return None
+
+    key = '{}|{}|{}|{}|{}'.format(os.path.abspath(fpath), mtime,
+            ALPHA_THOLD, ALPHA_BGND, ALPHA_FGND)
+
+    # uncompressed for a quick load
+    return (CACHE_DIR + 'bgnd_' +
+            hashlib.sha1(key.encode('utf-8')).hexdigest() + '.tif')
+
+#
+# keyed background from the cache, None if not there
+#
+def LoadKeyedBackground(fpath):
+    cpath = keyed_file(fpath)
+    if cpath is None or not os.path.exists(cpath):
+        return None
+
+    try:
+        img = Image.open(cpath)
+        img.load()
+    except OSError:
+        return None
+
+    return img
+
+#
+# keep the keyed background in the cache
+#
+def SaveKeyedBackground(fpath, img):
+    cpath = keyed_file(fpath)
+    if cpath is None:
+        return
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        img.save(cpath)
+    except OSError:
+        pass
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+# All the image settings on the page: the stages work in place on one page
+# buffer, the pixel and neighbourhood ones by tiles. The output of each
+# stage is kept, keyed by the page and the settings of the stages up to it,
+# so that a change is processed from the first stage it affects only.
+#
+def image_stages(settings, background=None, profile=None):
+    stages = []
+
+    # color correction: manual color balance done with the tone below
+    if settings['co'] == 'Calibration':
+        stages.append((('color', 'Calibration'),
+            lambda nimg: apply_calibration(nimg, 'Color')))
+    elif settings['co'] not in ('None', 'Manual'):
+        stages.append((('color', settings['co']),
+            lambda nimg: white_balance(nimg, settings['co'])))
+
+    # manual color balance, contrast and brightness in a single pass
+    cb = settings['cb'] if settings['co'] == 'Manual' else 1.0
+    if settings['gm'] == 'Manual':
+        ct, br = settings['ct'], settings['br']
+    else:
+        ct, br = 1.0, 1.0
+    if cb != 1.0 or ct != 1.0 or br != 1.0:
+        stages.append((('tone', cb, ct, br),
+            lambda nimg: tone(nimg, cb, ct, br)))
+
+    # gamma calibration
+    if settings['gm'] == 'Calibration':
+        stages.append((('gamma', 'Calibration'),
+            lambda nimg: apply_calibration(nimg, 'Gamma')))
+
+    # image centering
+    if settings['cn'] != 'None':
+        stages.append((('center', settings['cn']),
+            lambda nimg: center_buffer(nimg, settings['cn'], profile)))
+
+    # sharpen: manual sharpness or filter
+    if settings['sh'] == 'Manual':
+        if settings['sn'] != 1.0:
+            stages.append((('sharpen', 'Manual', settings['sn']),
+                lambda nimg: sharpness(nimg, settings['sn'])))
+    elif settings['sh'] != 'None':
+        stages.append((('sharpen', settings['sh']),
+            lambda nimg: apply_filter(nimg, settings['sh'])))
+
+    # watermark
+    if settings['wm'] != 'None':
+        stages.append((('watermark', settings['wm']),
+            lambda nimg: blend_layer(nimg, WatermarkLayer(settings['wm'],
+                (nimg.shape[1], nimg.shape[0])))))
+
+    # background
+    if settings['bk'] != 'None' and background is not None:
+        stages.append((('background', id(background)),
+            lambda nimg: blend_layer(nimg, BackgroundLayer(background,
+                (nimg.shape[1], nimg.shape[0])))))
+
+    return stages
+
+#
+# output of the stages kept within the memory budget, the least recently
+# used dropped first: the page and background are kept with it so that
+# their ids are not reused while cached
+#
+def cache_stage(key, refs, nimg):
+    global stage_bytes
+
+    if nimg.nbytes > STAGE_CACHE_BYTES:
+        return
+
+    with stage_lock:
+        if key in stage_cache:
+            stage_bytes = stage_bytes - stage_cache[key][1].nbytes
+        stage_cache[key] = (refs, nimg)
+        stage_bytes = stage_bytes + nimg.nbytes
+
+        while stage_bytes > STAGE_CACHE_BYTES:
+            refs, old = stage_cache.popitem(last=False)[1]
+            stage_bytes = stage_bytes - old.nbytes
+
+#
+# forget the outputs of the page, or of all the pages
+#
+def ClearStageCache(src=None):
+    global stage_bytes
+
+    with stage_lock:
+        for key in list(stage_cache):
+            if src is None or key[0] == id(src):
+                stage_bytes = stage_bytes - stage_cache.pop(key)[1].nbytes
+
+#
+# process the page into its page buffer, not to be changed as it is kept:
+# None if aborted by the event in between the stages
+#
+def ProcessBuffer(src, settings, background=None, profile=None, abort=None):
+    stages = image_stages(settings, background, profile)
+    refs = (src, background)
+
+    # keys of the stages: the settings up to them
+    keys = []
+    for (key, fn) in stages:
+        keys.append((keys[-1] if keys else (id(src),)) + (key,))
+
+    # the last output kept
+    with stage_lock:
+        start = len(stages)
+        while start > 0 and keys[start - 1] not in stage_cache:
+            start = start - 1
+        if start > 0:
+            stage_cache.move_to_end(keys[start - 1])
+            nimg = stage_cache[keys[start - 1]][1]
+
+    if start == 0:
+        nimg = page_buffer(src)
+    elif start < len(stages):
+        nimg = nimg.copy()
+
+    # the stages work in place: the kept outputs are not touched
+    for i in range(start, len(stages)):
+        if abort is not None and abort.is_set():
+            return None
+        nimg = stages[i][1](nimg)
+        if STAGE_CACHE_BYTES > 0:
+            cache_stage(keys[i], refs, nimg)
+            if i + 1 < len(stages):
+                nimg = nimg.copy()
+
+    return nimg
+
+#
+# thumbnail of the page buffer for the book, RGB
+#
+def Thumbnail(nimg):
+    return cv2.resize(rgb_buffer(nimg), THUMBNAIL_SIZE,
+            interpolation=cv2.INTER_AREA)
+
+#
+# copy of the page no smaller than the size for the interactive changes,
+# from its page buffer: lineart is shown gray
+#
+def Proxy(img, size=PROXY_SIZE):
+    factor = max(min(img.size[0] // size[0], img.size[1] // size[1]), 1)
+    if factor == 1:
+        return img
+
+    # whole blocks of factor by factor pixels averaged
+    (w,h) = (img.size[0] // factor, img.size[1] // factor)
+    nimg = page_buffer(img)[:h * factor, :w * factor]
+
+    return to_pil(cv2.resize(nimg, (w,h), interpolation=cv2.INTER_AREA))
 
 if __name__ == "__main__":
 
@@ -395,14 +1498,15 @@ if __name__ == "__main__":
 
         if 'find_canny_thresholds' in IPTEST:
             img = Image.open(IMAGE_DIR + '/bgnd_2.png')
-            find_canny_thresholds(img)
-            print('canny_low:', canny_low, ' canny_high:', canny_high)
+            low, high = find_canny_thresholds(img)
+            print('canny_low:', low, ' canny_high:', high)
 
         if 'GetRectifiedImage'in IPTEST:
             # Test rectification
             img = Image.open(IMAGE_DIR + '/test_2.png')
             rect, (cx,cy) = GetRectifiedImage(img)
             print('rect:', rect, '(cx,cy)',(cx,cy))
+            print('detection:', GetRectStats())
 
     else:
         print('')
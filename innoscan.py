@@ -11,6 +11,7 @@
 #   python NumPy package: www.numpy.org
 #   python PIL package: pillow.readthedocs.io
 #   python SANE package: python-sane.readthedocs.io
+#     (or SCAN_BACKEND = 'mocksane' to replay image files instead)
 #   python OpenCV package: www.opencv.org
 #   wxpython: wxpython.org
 #   PDFtk : www.pdflabs.com/tools/pdftk-the-pdf-toolkit
@@ -31,15 +32,22 @@ import os
 # wx
 import wx
 import wx.lib.imagebrowser as ib
+import wx.lib.newevent
 from wx.lib.mixins.rubberband import RubberBand
-# numpy and PIL
+# numpy, PIL and OpenCV
 import numpy as np
 from PIL import Image
+import cv2
 # local
 from settings import *
 import imgprocess as ipc
-from scanner import Scanner
+from scanner import Scanner, ScannerPool, LoadBackend
+from pagepool import PagePool, PageWorker
 
+# events posted by the acquisition thread
+ScanEvent, EVT_SCAN = wx.lib.newevent.NewEvent()
+PageEvent, EVT_PAGE = wx.lib.newevent.NewEvent()
+ProcessEvent, EVT_PROCESS = wx.lib.newevent.NewEvent()
 
 #--------1---------2---------3---------4---------5---------6---------7---------8
 #
@@ -61,6 +69,9 @@ class SetupDialog(wx.Dialog):
         self.choTxtSize = wx.Choice(self,-1,choices=[])
         self.choImgSize = wx.Choice(self,-1,choices=[])
         self.choImgSize.SetMinSize(CTRL_MIN_SIZE)
+        self.lblAdf = wx.StaticText(self,-1,"Feeder")
+        self.chkTxtAdf = wx.CheckBox(self,-1,"Batch")
+        self.chkImgAdf = wx.CheckBox(self,-1,"Batch")
         self.btnOK = wx.Button(self, wx.ID_OK, "OK")
         self.btnCancel = wx.Button(self, wx.ID_CANCEL, "Cancel")
 
@@ -72,7 +83,7 @@ class SetupDialog(wx.Dialog):
 
     def __do_layout(self):
         sizer_x = wx.BoxSizer(wx.VERTICAL)
-        sizer_g = wx.GridSizer(6, 3, 4, 4)
+        sizer_g = wx.GridSizer(7, 3, 4, 4)
         sizer_g.Add((20, 20), 0, wx.EXPAND, 0)
         sizer_g.Add(self.lblText, 0, wx.ALIGN_CENTER, 0)
         sizer_g.Add(self.lblImage, 0, wx.ALIGN_CENTER, 0)
@@ -85,6 +96,9 @@ class SetupDialog(wx.Dialog):
         sizer_g.Add(self.lblSize, 0, wx.ALIGN_CENTER, 0)
         sizer_g.Add(self.choTxtSize, 0, wx.EXPAND, 0)
         sizer_g.Add(self.choImgSize, 0, wx.EXPAND, 0)
+        sizer_g.Add(self.lblAdf, 0, wx.ALIGN_CENTER, 0)
+        sizer_g.Add(self.chkTxtAdf, 0, wx.EXPAND, 0)
+        sizer_g.Add(self.chkImgAdf, 0, wx.EXPAND, 0)
         sizer_g.Add((20, 20), 0, 0, 0)
         sizer_g.Add((20, 20), 0, 0, 0)
         sizer_g.Add((20, 20), 0, 0, 0)
@@ -96,7 +110,7 @@ class SetupDialog(wx.Dialog):
         sizer_x.Fit(self)
         self.Layout()
 
-    def FillChoiceLists(self, lstmode, lstres, lstsize):
+    def FillChoiceLists(self, lstmode, lstres, lstsize, feeder=True):
 
         for x in lstmode:
             self.choTxtMode.Append(x)
@@ -110,6 +124,12 @@ class SetupDialog(wx.Dialog):
             self.choTxtSize.Append(x)
             self.choImgSize.Append(x)
 
+        # batch scan only with a document feeder
+        if not feeder:
+            self.lblAdf.Disable()
+            self.chkTxtAdf.Disable()
+            self.chkImgAdf.Disable()
+
     def SetSelections(self, txtPrms, imgPrms):
 
         if txtPrms is None:
@@ -120,6 +140,8 @@ class SetupDialog(wx.Dialog):
             self.choTxtMode.SetStringSelection(txtPrms['mode'])
             self.choTxtRes.SetStringSelection(str(txtPrms['res']) + ' dpi')
             self.choTxtSize.SetStringSelection(txtPrms['size'])
+            self.chkTxtAdf.SetValue(txtPrms['adf'] and
+                    self.chkTxtAdf.IsEnabled())
 
         if imgPrms is None:
             self.choImgMode.SetSelection(0)
@@ -129,18 +151,22 @@ class SetupDialog(wx.Dialog):
             self.choImgMode.SetStringSelection(imgPrms['mode'])
             self.choImgRes.SetStringSelection(str(imgPrms['res']) + ' dpi')
             self.choImgSize.SetStringSelection(imgPrms['size'])
+            self.chkImgAdf.SetValue(imgPrms['adf'] and
+                    self.chkImgAdf.IsEnabled())
 
     def GetSelections(self):
         return (
             {
                 'mode':self.choTxtMode.GetStringSelection(),
                 'res':int(self.choTxtRes.GetStringSelection().partition(' ')[0]),
-                'size':self.choTxtSize.GetStringSelection()
+                'size':self.choTxtSize.GetStringSelection(),
+                'adf':self.chkTxtAdf.GetValue()
             },
             {
                 'mode':self.choImgMode.GetStringSelection(),
                 'res':int(self.choImgRes.GetStringSelection().partition(' ')[0]),
-                'size':self.choImgSize.GetStringSelection()
+                'size':self.choImgSize.GetStringSelection(),
+                'adf':self.chkImgAdf.GetValue()
             })
 
 
@@ -172,6 +198,13 @@ class ImagePanel(wx.Panel):
         self.r = 0
         self.mode = 'none'
         self.wximg = None
+        # display pyramid of the image and the bitmap fitting the window
+        self.pyramid = []
+        self.bitmap = None
+        # full resolution of the proxy shown, called before zooming
+        self.realize = None
+        # pages being scanned by device
+        self.previews = {}
         self.txtCoord = wx.TextCtrl(self, -1, '', style=wx.TE_READONLY)
         self.txtCoord.SetMinSize((160,28))
         self.sttInfo = wx.StaticText(self, -1, info)
@@ -195,41 +228,63 @@ class ImagePanel(wx.Panel):
         self.wndImage.Bind(wx.EVT_MOUSE_EVENTS, self.OnMouseEvents)
 
     #
-    # from numpy array to wx.image
+    # from page buffer to wx.image sharing its RGB pixels, which are not
+    # changed afterwards
     #
-    def SetNumpyData(self, data):
-        if data is None:
-            tmp = np.ones((INITIAL_PANEL_SIZE[1],INITIAL_PANEL_SIZE[0],3),
-                    dtype=np.uint8) * 127
+    def SetPage(self, page, realize=None):
+        self.realize = realize
 
-        elif data.shape[2] != 3:
-            # grayscale or monochrome
-            tmp = np.zeros((data.shape[0],data.shape[1],3),dtype=np.uint8)
-            # the same data for all plane
-            tmp[:,:,0] = data[:,:,0]
-            tmp[:,:,1] = data[:,:,0]
-            tmp[:,:,2] = data[:,:,0]
-        else:
-            # color
-            tmp = data
+        self.page = np.ascontiguousarray(ipc.rgb_buffer(page), dtype=np.uint8)
+        self.wximg = wx.ImageFromBuffer(self.page.shape[1], self.page.shape[0],
+                self.page)
+        # display pyramid: the page itself then the halves down to the minimum
+        self.pyramid = [self.page]
+        self.bitmap = None
 
-        # convert to image
-        self.wximg = wx.Image(tmp.shape[1],tmp.shape[0])
-        self.wximg.SetData(tmp.tostring())
-        # update panel
         self.Refresh()
 
     #
-    # from PIL image to wx.image
+    # level of the pyramid for the scale factor, made when first needed
     #
-    def SetPilImage(self, data):
-        if data is None:
-            self.wximg = wx.Image(INITIAL_PANEL_SIZE[0],INITIAL_PANEL_SIZE[1])
-        else:
-            self.wximg = wx.Image(data.size[0],data.size[1])
-            self.wximg.SetData(data.convert('RGB').tobytes())
+    def GetLevel(self, r):
+        idx = 0
+        while r <= 0.5 and max(self.pyramid[idx].shape) > PYRAMID_MIN_SIZE:
+            if idx + 1 == len(self.pyramid):
+                self.pyramid.append(cv2.pyrDown(self.pyramid[idx]))
+            idx = idx + 1
+            r = r * 2
 
-        self.Refresh()
+        return self.pyramid[idx]
+
+    #
+    # paint a band of the page being scanned by the device
+    #
+    def SetScanBand(self, device, top, band, size):
+        sx, sy = self.wndImage.GetClientSize()
+        r = min(float(sx)/size[0], float(sy)/size[1])
+
+        # new page starts
+        preview = self.previews.get(device)
+        if preview is None or top == 0:
+            preview = Image.new('RGB',
+                    (max(int(r*size[0]),1), max(int(r*size[1]),1)),
+                    (127,127,127))
+            self.previews[device] = preview
+
+        y0 = int(r*top)
+        y1 = int(r*(top + band.size[1]))
+        if y1 > y0:
+            preview.paste(band.convert('RGB').resize(
+                (preview.size[0], y1 - y0)), (0, y0))
+
+        self.wndImage.Refresh()
+
+    #
+    # scan of the device is over
+    #
+    def ClearScanBand(self, device):
+        self.previews.pop(device, None)
+        self.wndImage.Refresh()
 
     #
     # start rubberband
@@ -255,9 +310,17 @@ class ImagePanel(wx.Panel):
         if ext is None:
             return
 
+        # full resolution of the proxy
+        if self.realize is not None:
+            self.realize()
+        # scale factor of the image as it is painted
+        sx, sy = self.wndImage.GetClientSize()
+        r = min(float(sx)/self.wximg.GetWidth(),
+                float(sy)/self.wximg.GetHeight())
+
         # convert the region into image space
-        rect = wx.Rect(int(ext[0]/self.r+.5), int(ext[1]/self.r+.5),
-                int((ext[2]-ext[0])/self.r+.5),int((ext[3]-ext[1])/self.r+.5))
+        rect = wx.Rect(int(ext[0]/r+.5), int(ext[1]/r+.5),
+                int((ext[2]-ext[0])/r+.5),int((ext[3]-ext[1])/r+.5))
         # create bitmap data object
         clipdata = wx.BitmapDataObject()
         crop = self.wximg.GetSubImage(rect)
@@ -272,6 +335,19 @@ class ImagePanel(wx.Panel):
     #
     def OnPaint(self, evt=None):
 
+        # pages being scanned come first, side by side
+        if len(self.previews):
+            dc = wx.PaintDC(self.wndImage)
+            slot = dc.GetSize().GetWidth() // len(self.previews)
+            for i, preview in enumerate(self.previews.values()):
+                img = wx.Image(preview.size[0], preview.size[1])
+                img.SetData(preview.tobytes())
+                if preview.size[0] > slot:
+                    img = img.Scale(max(slot,1), max(int(preview.size[1] *
+                        slot / preview.size[0]),1))
+                dc.DrawBitmap(wx.Bitmap(img),i*slot,0)
+            return
+
         if self.wximg is None:
             return
 
@@ -285,16 +361,29 @@ class ImagePanel(wx.Panel):
         sy = dc.GetSize().GetHeight()
         # scale factor
         r = min(float(sx)/ix, float(sy)/iy) * self.scale
-        # resizing
-        img = self.wximg.Scale(int(r * ix), int(r * iy), RESIZE_QUALITY)
-        # create a bitmap from the image
-        bitmap = wx.Bitmap(img)
-        # draw bitmap
+
         if self.scale == 1:
-            dc.DrawBitmap(bitmap,0,0)
+            # bitmap kept for the window size
+            if self.bitmap is None or self.bitmap[0] != (sx,sy):
+                level = self.GetLevel(r)
+                img = cv2.resize(level, (int(r * ix), int(r * iy)),
+                        interpolation=ipc.INTERPOLATION[RESIZE_QUALITY])
+                self.bitmap = ((sx,sy),
+                        wx.Bitmap.FromBuffer(img.shape[1], img.shape[0], img))
+            dc.DrawBitmap(self.bitmap[1],0,0)
         else:
+            # the part of the magnified image in the window only
             pos = self.wndImage.ScreenToClient(wx.GetMousePosition())
-            dc.DrawBitmap(bitmap,pos[0]*(1-self.scale),pos[1]*(1-self.scale))
+            (ox,oy) = (pos[0]*(1-self.scale), pos[1]*(1-self.scale))
+            level = self.GetLevel(r)
+            (lx,ly) = (level.shape[1]/(r*ix), level.shape[0]/(r*iy))
+            mat = np.array([[lx, 0, -ox*lx], [0, ly, -oy*ly]])
+            bgnd = self.wndImage.GetBackgroundColour()
+            img = cv2.warpAffine(level, mat, (sx,sy),
+                    flags=ipc.INTERPOLATION[RESIZE_QUALITY] |
+                    cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_CONSTANT,
+                    borderValue=(bgnd.Red(), bgnd.Green(), bgnd.Blue()))
+            dc.DrawBitmap(wx.Bitmap.FromBuffer(sx, sy, img),0,0)
 
         # save the scale factor for later use
         self.r = r
@@ -333,6 +422,9 @@ class ImagePanel(wx.Panel):
 
             # enter zoom mode
             if evt.LeftDown():
+                # full resolution of the proxy
+                if self.realize is not None:
+                    self.realize()
                 # capture mouse event
                 self.wndImage.CaptureMouse()
                 # change scale factor
@@ -381,6 +473,11 @@ class ImageBook(wx.Listbook):
         self.data = []
         # background image
         self.background = None
+        # pages showing the scans in progress by device
+        self.scanpages = {}
+        # page being edited processed in the background
+        self.worker = PageWorker(self.PostProcessEvent)
+        self.worker.start()
 
         # image panel
         # default dummy page but without thumbnail
@@ -389,6 +486,7 @@ class ImageBook(wx.Listbook):
 
         # message binding
         self.Bind(wx.EVT_LISTBOOK_PAGE_CHANGED, self.OnPageChanged)
+        self.Bind(EVT_PROCESS, self.OnProcessEvent)
 
     #
     # delete current selected page
@@ -398,10 +496,17 @@ class ImageBook(wx.Listbook):
             return
 
         idx = self.GetSelection()
+        # pages showing the scans in progress
+        for dev, page in list(self.scanpages.items()):
+            if page is self.GetPage(idx):
+                self.scanpages.pop(dev)
         # delete corresponding page however thumbnail remains
         self.DeletePage(idx)
         # and delete data
-        self.data.pop(idx)
+        item = self.data.pop(idx)
+        ipc.ClearStageCache(item['src'])
+        if 'proxy' in item:
+            ipc.ClearStageCache(item['proxy'])
         # create empty page if all pages are deleted
         if self.GetPageCount() == 0:
             self.AddPage(ImagePanel(self, '', style=wx.BORDER_SUNKEN,
@@ -420,6 +525,25 @@ class ImageBook(wx.Listbook):
         self.GetPage(self.GetSelection()).CopyRBand()
         self.GetPage(self.GetSelection()).StopRBand()
 
+    #
+    # show a band of the page being scanned on the current page, each
+    # device with its own preview
+    #
+    def ShowScanBand(self, device, top, band, size):
+        # the page can be deleted in the meantime
+        if not self.scanpages.get(device):
+            self.scanpages[device] = self.GetPage(self.GetSelection())
+        self.scanpages[device].SetScanBand(device, top, band, size)
+
+    #
+    # remove the scan in progress: forgotten first, so that it never
+    # stands in the way of the scanned page
+    #
+    def ClearScanBand(self, device):
+        page = self.scanpages.pop(device, None)
+        if page:
+            page.ClearScanBand(device)
+
     #
     # page change event handler
     #
@@ -441,6 +565,9 @@ class ImageBook(wx.Listbook):
 
         # check if this is the first page
         if len(self.data) == 0:
+            # the scans in progress go on on the new page
+            for device in list(self.scanpages):
+                self.ClearScanBand(device)
             # delete placeholder page
             self.DeleteAllPages()
             # posiiton of the insertion
@@ -460,7 +587,7 @@ class ImageBook(wx.Listbook):
         # select the page
         self.SetSelection(idx)
         # draw image on the page
-        self.GetPage(idx).SetPilImage(item['res'])
+        self.GetPage(idx).SetPage(item['res'])
 
     #
     # update image and thumbnail
@@ -474,101 +601,21 @@ class ImageBook(wx.Listbook):
         # replace the thumbnail
         self.imglist.Replace(item['tidx'], item['icon'])
         # replace the image
-        self.GetPage(index).SetPilImage(item['res'])
+        self.GetPage(index).SetPage(item['res'])
 
     #
     # process data
     #
     def ProcessData(self, data):
-        res = data['src'].copy()
         settings = data['settings']
 
         wx.BeginBusyCursor()
 
-        # color correction
-        if settings['co'] == 'None':
-            pass
-        # calibration
-        elif settings['co'] == 'Calibration':
-            res = ipc.ApplyCalibration(res, 'Color')
-        # manual
-        elif settings['co'] == 'Manual':
-            # color blance
-            if settings['cb'] != 1.0:
-                res = ipc.AdjustColorBalance(res, settings['cb'])
-        # white balance
-        else:
-            res = ipc.AdjustWhiteBalance(res, settings['co'])
-
-        # gamma correction
-        if settings['gm'] == 'None':
-            pass
-        # calibration
-        elif settings['gm'] == 'Calibration':
-            res = ipc.ApplyCalibration(res, 'Gamma')
-        # manual
-        elif settings['gm'] == 'Manual':
-            # contrast
-            if settings['ct'] != 1.0:
-                res = ipc.AdjustContrast(res, settings['ct'])
-            # brightness
-            if settings['br'] != 1.0:
-                res = ipc.AdjustBrightness(res, settings['br'])
-
-        # image centering
-        if settings['cn'] != 'None':
-            # rectify image
-            rect, (cx,cy) = ipc.GetRectifiedImage(res)
-
-            if rect is not None:
-                # clean image
-                res.paste('white',(0,0,res.size[0]-1,res.size[1]-1))
-
-                # find the coodinate for the rectified image
-                if settings['cn'] == 'Horizontal':
-                    dx = int((res.size[0] - rect.size[0])/2 + 0.5)
-                    dy = int(cy - rect.size[1]/2 + 0.5)
-                elif settings['cn'] == 'Vertical':
-                    dx = int(cx - rect.size[0]/2 + 0.5)
-                    dy = int((res.size[1] - rect.size[1])/2 + 0.5)
-                else:
-                    dx = int((res.size[0] - rect.size[0])/2 + 0.5)
-                    dy = int((res.size[1] - rect.size[1])/2 + 0.5)
-
-                # then paste
-                res.paste(rect, (dx,dy))
-
-        # sharpen
-        if settings['sh'] == 'None':
-            pass
-        # manual
-        elif settings['sh'] == 'Manual':
-            # sharpness
-            if settings['sn'] != 1.0:
-                res = ipc.AdjustSharpness(res, settings['sn'])
-        # others
-        else:
-            res = ipc.ApplyFilter(res, settings['sh'])
-
-        # watermark
-        if settings['wm'] != 'None':
-            res = ipc.ApplyWatermark(res, settings['wm'])
-
-        # background
-        if settings['bk'] != 'None':
-            # FIXME size must match
-            res = res.convert('RGBA')
-            bgnd = self.background.resize(res.size)
-
-            # alpha composition
-            res = Image.alpha_composite(res,bgnd)
-            # return to RGB mode
-            res = res.convert('RGB')
+        res = ipc.ProcessBuffer(data['src'], settings, self.background,
+                data.get('profile'))
 
         # finally thumbnail
-        wximg = wx.Image(THUMBNAIL_SIZE[0],THUMBNAIL_SIZE[1])
-        wximg.SetData(res.resize(THUMBNAIL_SIZE).convert('RGB').tobytes())
-        icon = wximg.ConvertToBitmap()
+        icon = self.MakeIcon(ipc.Thumbnail(res))
 
         wx.EndBusyCursor()
 
@@ -576,20 +623,139 @@ class ImageBook(wx.Listbook):
         data['icon'] = icon
         data['res'] = res
 
+    #
+    # thumbnail bitmap for the image list
+    #
+    def MakeIcon(self, thumb):
+        return wx.Bitmap.FromBuffer(THUMBNAIL_SIZE[0],THUMBNAIL_SIZE[1],
+                thumb)
+
     #
     # update settings for the current data
     #
     def UpdateSettings(self, settings):
         index = self.GetSelection()
         self.data[index]['settings'] = settings
-        # it is necessary to update the image
-        self.UpdateImage(index)
+        # it is necessary to update the image: the proxy first
+        self.UpdatePreview(index)
+
+    #
+    # process the page in the background: the proxy first, the full
+    # resolution when the changes stop, or when it is needed
+    #
+    def UpdatePreview(self, index):
+        item = self.data[index]
+        if 'proxy' not in item:
+            item['proxy'] = ipc.Proxy(item['src'])
+
+        item['res'] = None
+        self.worker.Post(item, self.background)
+
+    #
+    # page processed in the background: only the result of the latest
+    # settings is shown
+    #
+    def OnProcessEvent(self, evt):
+        item = evt.job['item']
+        # the page can be deleted or given other settings in the meantime
+        for index, x in enumerate(self.data):
+            if x is item:
+                break
+        else:
+            return
+
+        # nor a proxy over the full resolution
+        if item['settings'] is not evt.job['settings'] or \
+                item['res'] is not None:
+            return
+
+        # the page is left unprocessed, processed again when needed
+        if evt.kind == 'error':
+            self.GetTopLevelParent().SetStatusText('Processing error: ' +
+                    evt.data)
+            return
+
+        (res, thumb) = evt.data
+        item['icon'] = self.MakeIcon(thumb)
+        self.imglist.Replace(item['tidx'], item['icon'])
+        if evt.kind == 'page':
+            item['res'] = res
+            self.GetPage(index).SetPage(res)
+        else:
+            self.GetPage(index).SetPage(res, lambda: self.Realize(item))
+
+    #
+    # called from the processing thread
+    #
+    def PostProcessEvent(self, kind, job, data):
+        wx.PostEvent(self, ProcessEvent(kind=kind, job=job, data=data))
+
+    #
+    # process the full resolution of the page shown as proxy now
+    #
+    def Realize(self, item):
+        if item.get('res') is not None:
+            return
+
+        for index, x in enumerate(self.data):
+            if x is item:
+                self.UpdateImage(index)
+                break
+
+    def RealizeAll(self):
+        for item in self.data:
+            self.Realize(item)
+
+    #
+    # terminate the processing thread
+    #
+    def StopProcessing(self):
+        self.worker.Stop()
+
+    #
+    # give the settings to the pages, all by default, and return them to be
+    # processed in the page pool
+    #
+    def SetSettings(self, settings, indices=None):
+        if indices is None:
+            indices = range(len(self.data))
+
+        items = []
+        for index in indices:
+            self.data[index]['settings'] = dict(settings)
+            items.append(self.data[index])
+
+        return items
+
+    #
+    # processed page back from the page pool
+    #
+    def PutProcessed(self, item, settings, res, thumb):
+        # the page can be deleted or given other settings in the meantime
+        for index, x in enumerate(self.data):
+            if x is item:
+                break
+        else:
+            return False
+
+        if item['settings'] is not settings:
+            return False
+
+        item['res'] = res
+        item['icon'] = self.MakeIcon(thumb)
+        self.imglist.Replace(item['tidx'], item['icon'])
+        self.GetPage(index).SetPage(res)
+
+        return True
 
     #
     # delete all data
     #
     def New(self):
         self.data = []
+        self.worker.Abort()
+        ipc.ClearStageCache()
+        self.scanpages = {}
         self.DeleteAllPages()
         # create empty page
         self.AddPage(ImagePanel(self, '', style=wx.BORDER_SUNKEN,
@@ -603,6 +769,12 @@ class ImageBook(wx.Listbook):
         if len(self.data) == 0:
             return
 
+        # pages still shown as proxies
+        self.RealizeAll()
+        # PIL image of the page buffer, one page at a time
+        def page(x):
+            return ipc.to_pil(x['res'], x['src'].mode)
+
         # divide into file name and extension
         fname,sep,fext = fpath.rpartition('.')
 
@@ -613,10 +785,10 @@ class ImageBook(wx.Listbook):
             if fext == 'pdf' or fext == 'PDF':
 
                 if 'dpi' in self.data[0]:
-                    self.data[0]['res'].save(fpath,
+                    page(self.data[0]).save(fpath,
                             resolution = self.data[0]['dpi'][0])
                 else:
-                    self.data[0]['res'].save(fpath)
+                    page(self.data[0]).save(fpath)
 
                 return True
 
@@ -624,10 +796,10 @@ class ImageBook(wx.Listbook):
             elif fext == 'jpg' or fext == 'JPG':
 
                 if 'dpi' in self.data[0]:
-                    self.data[0]['res'].save(fpath, dpi=self.data[0]['dpi'],
+                    page(self.data[0]).save(fpath, dpi=self.data[0]['dpi'],
                             quality = JPGQUALITY)
                 else:
-                    self.data[0]['res'].save(fpath, quality = JPGQUALITY)
+                    page(self.data[0]).save(fpath, quality = JPGQUALITY)
 
                 return True
 
@@ -635,10 +807,10 @@ class ImageBook(wx.Listbook):
             elif fext == 'png' or fext == 'PNG':
 
                 if 'dpi' in self.data[0]:
-                    self.data[0]['res'].save(fpath, dpi = self.data[0]['dpi'],
+                    page(self.data[0]).save(fpath, dpi = self.data[0]['dpi'],
                             optimize = PNGOPTIMIZ)
                 else:
-                    self.data[0]['res'].save(fpath,
+                    page(self.data[0]).save(fpath,
                             optimize = PNGOPTIMIZ)
 
                 return True
@@ -647,7 +819,7 @@ class ImageBook(wx.Listbook):
             else:
                 # possibility of unsupported format
                 try:
-                    self.data[0]['res'].save(fpath)
+                    page(self.data[0]).save(fpath)
                 except:
                     return False
                 else:
@@ -663,9 +835,9 @@ class ImageBook(wx.Listbook):
 
                 for idx, x in enumerate(self.data):
                     if 'dpi' in x:
-                        x['res'].save(flist[idx], resolution = x['dpi'][0])
+                        page(x).save(flist[idx], resolution = x['dpi'][0])
                     else:
-                        x['res'].save(flist[idx])
+                        page(x).save(flist[idx])
 
                 # merge pdf if possible
                 cmd = 'pdftk'
@@ -684,10 +856,10 @@ class ImageBook(wx.Listbook):
 
                 for idx, x in enumerate(self.data):
                     if 'dpi' in x:
-                        x['res'].save(flist[idx], dpi = x['dpi'],
+                        page(x).save(flist[idx], dpi = x['dpi'],
                                 quality = JPGQUALITY)
                     else:
-                        x['res'].save(flist[idx], quality = JPGQUALITY)
+                        page(x).save(flist[idx], quality = JPGQUALITY)
 
                 return True
 
@@ -696,10 +868,10 @@ class ImageBook(wx.Listbook):
 
                 for idx, x in enumerate(self.data):
                     if 'dpi' in x:
-                        x['res'].save(flist[idx], dpi = x['dpi'],
+                        page(x).save(flist[idx], dpi = x['dpi'],
                                 optimize = PNGOPTIMIZ)
                     else:
-                        x['res'].save(flist[idx], optimize = PNGOPTIMIZ)
+                        page(x).save(flist[idx], optimize = PNGOPTIMIZ)
 
                 return True
 
@@ -707,7 +879,7 @@ class ImageBook(wx.Listbook):
             else:
                 for idx, x in enumerate(self.data):
                     try:
-                        x['res'].save(flist[idx])
+                        page(x).save(flist[idx])
                     except:
                         return False
 
@@ -745,6 +917,7 @@ class MyFrame(wx.Frame):
         self.tidSave = wx.NewId()
         self.tidSetup = wx.NewId()
         self.tidDevice = wx.NewId()
+        self.tidAbort = wx.NewId()
         # choice tool
         self.choDevice = wx.Choice(self.toolbar,self.tidDevice,choices=[])
 
@@ -805,6 +978,9 @@ class MyFrame(wx.Frame):
         # calibration
         self.sttCalibration = wx.StaticText(self.pnlSide, -1, 'Calibration')
         self.btnMacbeth = wx.Button(self.pnlSide, -1, 'Macbeth Chart')
+        # settings to all the pages
+        self.sttApply = wx.StaticText(self.pnlSide, -1, 'Apply Settings')
+        self.btnApplyAll = wx.Button(self.pnlSide, -1, 'All Pages')
 
         self.__set_properties()
         self.__do_layout()
@@ -860,7 +1036,7 @@ class MyFrame(wx.Frame):
         sizer_lhs = wx.BoxSizer(wx.VERTICAL)
         sizer_lhs.Add(self.lbkScan, 1, wx.ALL|wx.EXPAND, 4)
 
-        sizer_g = wx.FlexGridSizer(12,2,8,8)
+        sizer_g = wx.FlexGridSizer(13,2,8,8)
 
         sizer_g.Add(self.sttColor, 0, wx.ALIGN_CENTRE_VERTICAL, 0)
         sizer_g.Add(self.choColor, 0, wx.EXPAND, 0)
@@ -894,6 +1070,9 @@ class MyFrame(wx.Frame):
 
         sizer_g.Add(self.sttCalibration, 0, wx.ALIGN_CENTRE_VERTICAL, 0)
         sizer_g.Add(self.btnMacbeth, 0, wx.EXPAND, 0)
+
+        sizer_g.Add(self.sttApply, 0, wx.ALIGN_CENTRE_VERTICAL, 0)
+        sizer_g.Add(self.btnApplyAll, 0, wx.EXPAND, 0)
         self.pnlSide.SetSizer(sizer_g)
 
         sizer_rhs = wx.BoxSizer(wx.VERTICAL)
@@ -926,8 +1105,15 @@ class MyFrame(wx.Frame):
         self.pnlSide.SetBackgroundColour(bgnd)
         self.pnlSide.SetForegroundColour(fgnd)
 
-        # initialize scanner
-        self.scanner = Scanner()
+        # initialize scanner: each opened device has its acquisition thread
+        self.scanner = Scanner(DEVICE_CACHE, LoadBackend(SCAN_BACKEND))
+        self.pool = ScannerPool(self.scanner, self.PostScanEvent,
+                SCAN_BAND_PERIOD)
+        # image settings applied to many pages in worker processes
+        self.pages = PagePool(self.PostPageEvent)
+        self.devlist = []
+        # device for the next scan
+        self.device = None
         # image book get focus
         self.lbkScan.SetFocus()
         # clear dirty flag
@@ -936,16 +1122,20 @@ class MyFrame(wx.Frame):
         self.txtScanPrms = {
                 'mode':DEFAULT_TXT_MODE,
                 'res':DEFAULT_TXT_RES,
-                'size':DEFAULT_TXT_SIZE}
+                'size':DEFAULT_TXT_SIZE,
+                'adf':DEFAULT_TXT_ADF}
         self.imgScanPrms = {
                 'mode':DEFAULT_IMG_MODE,
                 'res':DEFAULT_IMG_RES,
-                'size':DEFAULT_IMG_SIZE}
+                'size':DEFAULT_IMG_SIZE,
+                'adf':DEFAULT_IMG_ADF}
         # disable controls
         self.EnableControls('Init')
 
         # MAIN_EVENT_HANDLERS
         self.Bind(wx.EVT_CLOSE, self.OnClose)
+        self.Bind(EVT_SCAN, self.OnScanEvent)
+        self.Bind(EVT_PAGE, self.OnPageEvent)
         # image settings - color
         self.Bind(wx.EVT_CHOICE, self.OnImgSettings, self.choColor)
         self.Bind(wx.EVT_SPINCTRLDOUBLE, self.OnImgSettings, self.spnCbalance)
@@ -962,6 +1152,7 @@ class MyFrame(wx.Frame):
         self.Bind(wx.EVT_CHOICE, self.OnImgSettings, self.choBackground)
         # calibration buttons
         self.Bind(wx.EVT_BUTTON, self.OnMacbethScan, self.btnMacbeth)
+        self.Bind(wx.EVT_BUTTON, self.OnApplyAll, self.btnApplyAll)
         # toolbar
         self.Bind(wx.EVT_TOOL, self.OnToolClick, id=self.tidNew)
         self.Bind(wx.EVT_TOOL, self.OnToolClick, id=self.tidText)
@@ -972,6 +1163,10 @@ class MyFrame(wx.Frame):
         self.Bind(wx.EVT_TOOL, self.OnToolClick, id=self.tidSave)
         self.Bind(wx.EVT_TOOL, self.OnToolClick, id=self.tidSetup)
         self.Bind(wx.EVT_CHOICE, self.OnSelectDevice, id=self.tidDevice)
+        # escape key aborts the scan
+        self.SetAcceleratorTable(wx.AcceleratorTable([
+            (wx.ACCEL_NORMAL, wx.WXK_ESCAPE, self.tidAbort)]))
+        self.Bind(wx.EVT_MENU, self.OnAbortScan, id=self.tidAbort)
 
     #
     # close event handler
@@ -983,8 +1178,10 @@ class MyFrame(wx.Frame):
                     'Confirm', wx.YES_NO) == wx.NO:
                 return
 
-        if self.scanner is not None:
-            self.scanner.Close()
+        # the devices are closed by the acquisition threads
+        self.pool.Stop()
+        self.pages.Stop()
+        self.lbkScan.StopProcessing()
 
         evt.Skip()
 
@@ -992,24 +1189,118 @@ class MyFrame(wx.Frame):
     # scan Macbeth chart and open calibration dialog
     #
     def OnMacbethScan(self, evt):
-        if self.scanner is None:
+        if self.device is None:
             return
-        wx.BeginBusyCursor()
         # set scanner settings for calibration scan
-        img = self.scanner.ScanImage()
-        # get rectified image
-        rect, (cx,cy) = ipc.GetRectifiedImage(img)
-        # create calibration dialog instance
-        dlg = CalibDialog(self, rect)
+        self.status.SetStatusText('Scanning Macbeth chart...')
+        self.pool.PostTo(self.device, 'scan', target='Macbeth')
 
-        if dlg.ShowModal() == wx.ID_OK:
-            # save calibration data
-            pass
+    #
+    # abort the scan and the page processing in progress
+    #
+    def OnAbortScan(self, evt=None):
+        self.pool.Abort()
+        if self.pages.IsBusy():
+            self.pages.Abort()
+            self.status.SetStatusText('Applying settings aborted')
 
-        dlg.Destroy()
+    #
+    # apply the current image settings to all the pages
+    #
+    def OnApplyAll(self, evt=None):
+        if len(self.lbkScan.data) == 0:
+            return
 
-        # TODO: return scanner setting
-        wx.EndBusyCursor()
+        items = self.lbkScan.SetSettings(self.GetImgSettings())
+        self.pages.Apply(items, self.lbkScan.background)
+        self.status.SetStatusText('Applying settings to {:d} pages...'
+                ' (Esc to abort)'.format(len(items)))
+        self.dirty = True
+
+    #
+    # page pool event handler: pages come back in any order
+    #
+    def OnPageEvent(self, evt):
+        if evt.kind == 'page':
+            job = evt.job
+            self.lbkScan.PutProcessed(job['item'], job['settings'], *evt.data)
+            batch = job['batch']
+            self.status.SetStatusText('Applying settings - page {:d}/{:d}'
+                    '... (Esc to abort)'.format(batch['done'], batch['count']))
+
+        elif evt.kind == 'error':
+            self.status.SetStatusText('Processing error: ' + evt.data)
+
+        elif evt.kind == 'done':
+            if not evt.job['aborted']:
+                self.status.SetStatusText('Applied settings to {:d} pages'
+                        .format(evt.data))
+
+    #
+    # acquisition thread event handler
+    #
+    def OnScanEvent(self, evt):
+        job = evt.job
+
+        if evt.kind == 'band':
+            self.lbkScan.ShowScanBand(job['device'], *evt.data)
+
+        elif evt.kind == 'error':
+            self.lbkScan.ClearScanBand(job.get('device'))
+            self.status.SetStatusText('Scanner error: ' + evt.data)
+            if job['cmd'] == 'devlist':
+                self.FillDevices([])
+            elif job['cmd'] == 'open':
+                self.pool.Close(job['device'])
+                wx.MessageBox('Failed to open the scanner')
+
+        elif evt.kind == 'progress':
+            if job['cmd'] == 'batch':
+                self.status.SetStatusText('Scanning' + job['info'] +
+                        '- page {:d}... (Esc to abort)'.format(evt.data + 1))
+            else:
+                self.status.SetStatusText('Scanning' + job.get('info', '') +
+                        '... (Esc to abort)')
+
+        elif evt.kind == 'page':
+            # pages are processed while the feeder goes on
+            self.lbkScan.ClearScanBand(job['device'])
+            self.AddScannedPage(job, evt.data)
+
+        elif job['cmd'] == 'devlist':
+            self.FillDevices(evt.data)
+            # check the list of the previous run in the background
+            if job['cached']:
+                self.pool.Post('refresh')
+
+        elif job['cmd'] == 'refresh':
+            self.RefreshDevices(evt.data)
+
+        elif job['cmd'] == 'open':
+            if evt.data:
+                # opened device name
+                self.status.SetStatusText(job['name'] + ' is ready')
+                # finally enable buttons
+                self.EnableControls('Normal')
+            else:
+                self.pool.Close(job['device'])
+                wx.MessageBox('Failed to open the scanner')
+
+        elif job['cmd'] == 'scan':
+            self.lbkScan.ClearScanBand(job['device'])
+            if evt.data is None:
+                self.status.SetStatusText('No image from the scanner')
+            elif job.get('target') == 'Macbeth':
+                self.Calibrate(evt.data)
+            elif job.get('target') == 'Preview':
+                self.ScanContent(job, evt.data)
+            else:
+                self.status.SetStatusText('Scanned' + job['info'])
+                self.AddScannedPage(job, evt.data)
+
+        elif job['cmd'] == 'batch':
+            self.status.SetStatusText('Scanned' + job['info'] +
+                    '- {:d} pages'.format(evt.data))
 
     #
     # image settings changed
@@ -1071,6 +1362,14 @@ class MyFrame(wx.Frame):
 
             dlg.Destroy()
 
+        # watermark needs a font
+        if self.choWatermark.GetStringSelection() != 'None' and \
+                ipc.GetWatermarkFont() is None:
+            wx.MessageBox("No font file found in the resource folder.\n" +
+                    "Copy a font file (*.ttf) into the folder ({}).".format(
+                     FONT_DIR))
+            self.choWatermark.SetSelection(0)
+
         # update settings for the selected page
         if len(self.lbkScan.data):
             self.lbkScan.UpdateSettings(self.GetImgSettings())
@@ -1080,24 +1379,18 @@ class MyFrame(wx.Frame):
     #
     def OnSelectDevice(self, evt=None):
 
-        for idx, x in enumerate(self.scanner.GetDevList()):
+        for idx, x in enumerate(self.devlist):
 
             if x[2] == self.choDevice.GetStringSelection():
-                self.status.SetStatusText('Opening ' + x[2])
-
-                wx.BeginBusyCursor()
-
-                # open the device
-                if self.scanner.Open(idx):
-                    # opened device name
+                # next scans go to this device
+                self.device = x[0]
+                # the other devices remain open
+                if self.pool.IsOpen(x[0]):
                     self.status.SetStatusText(x[2] + ' is ready')
-                    # finally enable buttons
-                    self.EnableControls('Normal')
-
                 else:
-                    wx.MessageBox('Failed to open the scanner')
-
-                wx.EndBusyCursor()
+                    self.status.SetStatusText('Opening ' + x[2])
+                    # open the device in its acquisition thread
+                    self.pool.Open(x[0], name=x[2])
                 # break anyway
                 break
 
@@ -1168,11 +1461,15 @@ class MyFrame(wx.Frame):
 
         # change default scan mode
         elif tid == self.tidSetup:
+            scanner = self.pool.GetScanner(self.device)
+            if scanner is None:
+                return
             dlg = SetupDialog(self)
             dlg.FillChoiceLists(
-                    self.scanner.GetModes(),
-                    self.scanner.GetResolutions(),
-                    self.scanner.GetScanAreas())
+                    scanner.GetModes(),
+                    scanner.GetResolutions(),
+                    scanner.GetScanAreas(),
+                    scanner.GetFeeder() is not None)
             dlg.SetSelections(self.txtScanPrms, self.imgScanPrms)
 
             if dlg.ShowModal() == wx.ID_OK:
@@ -1186,34 +1483,94 @@ class MyFrame(wx.Frame):
     #
     def ScanPage(self, target='Image'):
 
-        if self.scanner is None:
+        scanner = self.pool.GetScanner(self.device)
+        if scanner is None:
             return
 
         if target == 'Text':
             mode = self.txtScanPrms['mode']
             res = self.txtScanPrms['res']
             size = self.txtScanPrms['size']
+            adf = self.txtScanPrms['adf']
         elif target == 'Image':
             mode = self.imgScanPrms['mode']
             res = self.imgScanPrms['res']
             size = self.imgScanPrms['size']
+            adf = self.imgScanPrms['adf']
         else:
             return
-        # setup the scanner first
-        self.scanner.SetMode(mode)
-        self.scanner.SetScanArea(size)
-        self.scanner.SetResolution(res)
 
-        # save PIL image with current scan conditions and image settings
-        wx.BeginBusyCursor()
+        # batch set for another device with a feeder
+        if scanner.GetFeeder() is None:
+            adf = False
+
+        info = ' {:s} - {:s} - {:d} dpi - {:s} '.format(
+                scanner.GetName(), mode, res, size)
+
+        # quick preview of the platen first to find the content
+        if size == 'Auto' and not adf:
+            self.pool.PostTo(self.device, 'scan', mode=mode, size=size,
+                    res=scanner.GetPreviewResolution(PREVIEW_RES),
+                    target='Preview', final=res, info=info,
+                    settings=self.GetImgSettings())
+            return
+
+        # the page is added to the book when the scan is done
+        self.pool.PostTo(self.device, 'batch' if adf else 'scan',
+                mode=mode, res=res, size=size, info=info,
+                settings=self.GetImgSettings())
+
+    #
+    # preview is done: scan the content area only at full resolution
+    #
+    def ScanContent(self, job, img):
+        bounds = ipc.FindContentBounds(img)
+
+        if bounds is None:
+            # nothing found: the whole platen then
+            size = 'Auto'
+        else:
+            # pixels to mm with some margin
+            mm = 25.4 / job['res']
+            (px, py) = self.pool.GetScanner(job['device']).platen
+            size = (max(bounds[0] * mm - PREVIEW_MARGIN, 0),
+                    max(bounds[1] * mm - PREVIEW_MARGIN, 0),
+                    min(bounds[2] * mm + PREVIEW_MARGIN, px),
+                    min(bounds[3] * mm + PREVIEW_MARGIN, py))
+
+        self.pool.PostTo(job['device'], 'scan', mode=job['mode'],
+                res=job['final'], size=size, info=job['info'],
+                settings=job['settings'])
+
+    #
+    # add a scanned page with its scan conditions and image settings
+    #
+    def AddScannedPage(self, job, img):
         self.lbkScan.AddData({
-            'src':self.scanner.ScanImage(),
-            'info':' {:s} - {:d} dpi - {:s} '.format(mode, res, size),
-            'dpi':(self.scanner.GetResolution(),self.scanner.GetResolution()),
-            'settings':self.GetImgSettings()})
-        wx.EndBusyCursor()
+            'src':img,
+            'device':job['device'],
+            'info':job['info'],
+            'dpi':(job['res'],job['res']),
+            'profile':(job['device'],job['mode'],job['res']),
+            'settings':dict(job['settings'])})
         self.dirty = True
 
+    #
+    # scan Macbeth chart is done: open calibration dialog
+    #
+    def Calibrate(self, img):
+        # get rectified image
+        rect, (cx,cy) = ipc.GetRectifiedImage(img)
+        # create calibration dialog instance
+        dlg = CalibDialog(self, rect)
+
+        if dlg.ShowModal() == wx.ID_OK:
+            # save calibration data
+            pass
+
+        dlg.Destroy()
+        # TODO: return scanner setting
+
     #
     # save data to file(s)
     #
@@ -1236,6 +1593,12 @@ class MyFrame(wx.Frame):
     #
     def LoadFile(self, fpath, background = False):
 
+        # background keyed before
+        if background:
+            img = ipc.LoadKeyedBackground(fpath)
+            if img is not None:
+                return img, None
+
         try:
             src = Image.open(fpath)
         except:
@@ -1246,21 +1609,8 @@ class MyFrame(wx.Frame):
 
         # insert alpha channel with
         if background:
-            # convert to RGBA
-            img = src.convert("RGBA")
-            # extract data
-            data = list(img.getdata())
-            for idx,pxl in enumerate(data):
-                if (pxl[0] > ALPHA_THOLD and pxl[1] > ALPHA_THOLD and
-                        pxl[2] > ALPHA_THOLD):
-                    # clear alpha channel valu
-                    data[idx] = (pxl[0],pxl[1],pxl[2],ALPHA_BGND)
-                else:
-                    # set alpha channel value
-                    data[idx] = (pxl[0],pxl[1],pxl[2],ALPHA_FGND)
-
-            # reassemble
-            img.putdata(data)
+            img = ipc.KeyBackground(src)
+            ipc.SaveKeyedBackground(fpath, img)
 
             return img, None
 
@@ -1389,11 +1739,15 @@ class MyFrame(wx.Frame):
     # enumerate scanner devices
     #
     def EnumerateDevices(self):
+        # enumeration takes time: the list comes back with EVT_SCAN
+        self.pool.Post('devlist')
 
-        # enumerate devices
-        wx.BeginBusyCursor()
-        devlist = self.scanner.GetDevList()
-        wx.EndBusyCursor()
+    #
+    # fill the device choice box with the enumerated devices
+    #
+    def FillDevices(self, devlist):
+
+        self.devlist = devlist
 
         if len(devlist) == 0:
             wx.MessageBox('No scanner found...')
@@ -1411,6 +1765,38 @@ class MyFrame(wx.Frame):
                 self.status.SetStatusText('Select a scanner.')
                 self.EnableControls('Select')
 
+    #
+    # device list has been refreshed
+    #
+    def RefreshDevices(self, devlist):
+
+        if devlist == self.devlist:
+            return
+
+        name = self.choDevice.GetStringSelection()
+        self.choDevice.Clear()
+
+        if name in [x[2] for x in devlist]:
+            # keep the current device
+            self.devlist = devlist
+            for x in devlist:
+                self.choDevice.Append(x[2])
+            self.choDevice.SetStringSelection(name)
+        else:
+            self.FillDevices(devlist)
+
+    #
+    # called from the acquisition thread
+    #
+    def PostScanEvent(self, kind, job, data):
+        wx.PostEvent(self, ScanEvent(kind=kind, job=job, data=data))
+
+    #
+    # called from the page pool thread
+    #
+    def PostPageEvent(self, kind, job, data):
+        wx.PostEvent(self, PageEvent(kind=kind, job=job, data=data))
+
     #
     # create a bitmap from the image file
     #
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+#
+# Stand-in for the python-sane module replaying image files as scans
+#
+# The acquisition path can be tested and profiled without a scanner.
+# Select it by setting SCAN_BACKEND (or INNOSCAN_BACKEND environment
+# variable) to 'mocksane'. The behaviour is controlled by the MOCK_*
+# parameters of the settings, which can also be changed in the config
+# dictionary before open().
+#
+
+import glob
+import random
+import threading
+import time
+from PIL import Image
+from settings import *
+
+config = {
+        'files': MOCK_FILES,
+        'devices': MOCK_DEVICES,
+        'modes': MOCK_MODES,
+        'resolutions': MOCK_RESOLUTIONS,
+        'platen': MOCK_PLATEN,
+        'line_delay': MOCK_LINE_DELAY,
+        'adf_pages': MOCK_ADF_PAGES,
+        'fail_rate': MOCK_FAIL_RATE,
+        }
+
+# option types and units as in sane
+TYPE_BOOL, TYPE_INT, TYPE_FIXED, TYPE_STRING, TYPE_BUTTON, TYPE_GROUP = \
+        range(6)
+UNIT_NONE, UNIT_PIXEL, UNIT_BIT, UNIT_MM, UNIT_DPI = range(5)
+# option capability: soft select, soft detect
+CAP_SOFT = 5
+# lines filled at a time
+BAND_LINES = 16
+
+
+class error(Exception):
+    pass
+
+def init():
+    return (1, 0, 0, 0)
+
+def exit():
+    pass
+
+#
+# (device name, vendor, model, type)
+#
+def get_devices(localOnly=False):
+    return [('mock:{:d}'.format(i), 'Innomatic', 'File Replay {:d}'.format(i),
+        'flatbed scanner') for i in range(config['devices'])]
+
+def open(devname):
+    if devname not in [x[0] for x in get_devices()]:
+        raise error('Invalid argument')
+
+    return MockDevice(devname)
+
+
+#
+# emulation of sane.SaneDev
+#
+class MockDevice:
+
+    def __init__(self, devname):
+        d = self.__dict__
+        d['devname'] = devname
+        d['files'] = sorted(glob.glob(config['files']))
+        d['nfile'] = 0
+        d['pages'] = config['adf_pages']
+        d['cancelled'] = threading.Event()
+        d['scanning'] = False
+        # option table in the format of sane get_options()
+        pw, ph = config['platen']
+        d['options'] = [
+            (0, 'standard', 'Standard', '', TYPE_GROUP, UNIT_NONE,
+                0, 0, None),
+            (1, 'mode', 'Scan mode', '', TYPE_STRING, UNIT_NONE,
+                32, CAP_SOFT, list(config['modes'])),
+            (2, 'source', 'Scan source', '', TYPE_STRING, UNIT_NONE,
+                32, CAP_SOFT, ['Flatbed', 'ADF']),
+            (3, 'resolution', 'Scan resolution', '', TYPE_INT, UNIT_DPI,
+                4, CAP_SOFT, list(config['resolutions'])),
+            (4, 'geometry', 'Geometry', '', TYPE_GROUP, UNIT_NONE,
+                0, 0, None),
+            (5, 'tl-x', 'Top-left x', '', TYPE_FIXED, UNIT_MM,
+                4, CAP_SOFT, (0.0, float(pw), 0.0)),
+            (6, 'tl-y', 'Top-left y', '', TYPE_FIXED, UNIT_MM,
+                4, CAP_SOFT, (0.0, float(ph), 0.0)),
+            (7, 'br-x', 'Bottom-right x', '', TYPE_FIXED, UNIT_MM,
+                4, CAP_SOFT, (0.0, float(pw), 0.0)),
+            (8, 'br-y', 'Bottom-right y', '', TYPE_FIXED, UNIT_MM,
+                4, CAP_SOFT, (0.0, float(ph), 0.0)),
+            ]
+        d['opt'] = dict((x[1].replace('-','_'), x) for x in d['options']
+                if x[4] != TYPE_GROUP)
+        # current values
+        d['values'] = {'mode':config['modes'][0], 'source':'Flatbed',
+                'resolution':config['resolutions'][0],
+                'tl_x':0.0, 'tl_y':0.0, 'br_x':float(pw), 'br_y':float(ph)}
+
+    def __getattr__(self, key):
+        try:
+            return self.__dict__['values'][key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        if key not in self.opt:
+            raise AttributeError('No such option: ' + key)
+
+        cons = self.opt[key][-1]
+        if isinstance(cons, list):
+            if value not in cons:
+                raise error('Invalid argument')
+        elif isinstance(cons, tuple):
+            value = min(max(float(value), cons[0]), cons[1])
+
+        self.values[key] = value
+
+    def get_options(self):
+        return list(self.options)
+
+    #
+    # (format, last_frame, (pixels_per_line, lines), depth, bytes_per_line)
+    #
+    def get_parameters(self):
+        mm = self.resolution / 25.4
+        width = max(int((self.br_x - self.tl_x) * mm), 1)
+        lines = max(int((self.br_y - self.tl_y) * mm), 1)
+
+        if self.mode == 'Color':
+            return ('color', True, (width, lines), 8, width * 3)
+        elif self.mode == 'Gray':
+            return ('gray', True, (width, lines), 8, width)
+        else:
+            return ('gray', True, (width, lines), 1, (width + 7)//8)
+
+    def start(self):
+        self.cancelled.clear()
+
+        if self.source == 'ADF':
+            if self.pages == 0:
+                # the feeder is refilled for the next batch
+                self.__dict__['pages'] = config['adf_pages']
+                raise error('Document feeder out of documents')
+            self.__dict__['pages'] = self.pages - 1
+
+        if random.random() < config['fail_rate']:
+            raise error('Error during device I/O')
+
+        self.__dict__['scanning'] = True
+
+    def cancel(self):
+        self.cancelled.set()
+
+    #
+    # read the whole frame
+    #
+    def snap(self, no_cancel=False):
+        fmt, last, size, depth, bpl = self.get_parameters()
+        img = Image.new('RGB' if fmt == 'color' else 'L', size)
+        self.snap_into(img, no_cancel)
+
+        if depth == 1:
+            img = img.convert('1')
+
+        return img
+
+    #
+    # fill the image line by line with the read latency
+    #
+    def snap_into(self, img, no_cancel=False, filled=None):
+        if not self.scanning:
+            raise error('Invalid argument')
+        self.__dict__['scanning'] = False
+
+        page = self.NextPage(img.mode, img.size)
+
+        for top in range(0, img.size[1], BAND_LINES):
+            bottom = min(top + BAND_LINES, img.size[1])
+            time.sleep(config['line_delay'] * (bottom - top))
+
+            if self.cancelled.is_set():
+                raise error('Operation was cancelled')
+
+            img.paste(page.crop((0, top, img.size[0], bottom)), (0, top))
+            if filled is not None:
+                filled(bottom)
+
+    #
+    # next image file cropped to the scan area
+    #
+    def NextPage(self, mode, size):
+        if len(self.files) == 0:
+            # blank page if there is no file to replay
+            return Image.new(mode, size, 'white')
+
+        src = Image.open(self.files[self.nfile % len(self.files)])
+        self.__dict__['nfile'] = self.nfile + 1
+
+        # the file covers the whole platen
+        pw, ph = config['platen']
+        src = src.convert(mode).resize(
+                (int(pw * self.resolution / 25.4),
+                 int(ph * self.resolution / 25.4)))
+        left = int(self.tl_x * self.resolution / 25.4)
+        top = int(self.tl_y * self.resolution / 25.4)
+
+        return src.crop((left, top, left + size[0], top + size[1]))
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return '<MockDevice ' + self.devname + '>'
+
+
+if __name__ == '__main__':
+
+    from scanner import Scanner
+
+    import sys
+    print('Replaying', config['files'], '--------------------------')
+    myscanner = Scanner(backend=sys.modules[__name__])
+    print('DevList: ', myscanner.GetDevList())
+    print('Opening the first one on the list', myscanner.Open(0))
+
+    for res in config['resolutions']:
+        myscanner.SetResolution(res)
+        t = time.time()
+        img = myscanner.ScanImage(lambda top, band, size: None)
+        print('{:d} dpi: {} {:.2f} sec'.format(res, img.size, time.time() - t))
+
+    myscanner.SetResolution(config['resolutions'][0])
+    t = time.time()
+    pages = list(myscanner.ScanBatch())
+    print('ADF: {:d} pages {:.2f} sec'.format(len(pages), time.time() - t))
+
+    # the whole path of a page: scan, image settings and save
+    import os
+    import tempfile
+    import imgprocess as ipc
+    settings = {'co':'Stretch', 'cb':1.0, 'gm':'Manual', 'ct':1.2,
+            'br':1.1, 'sh':'Detail', 'sn':1.0, 'cn':'Both', 'wm':'None',
+            'bk':'None'}
+    fpath = os.path.join(tempfile.gettempdir(), 'mocksane.png')
+    for res in config['resolutions']:
+        myscanner.SetResolution(res)
+        t0 = time.time()
+        img = myscanner.ScanImage(lambda top, band, size: None)
+        t1 = time.time()
+        nimg = ipc.ProcessBuffer(img, settings)
+        t2 = time.time()
+        ipc.to_pil(nimg, img.mode).save(fpath)
+        t3 = time.time()
+        print('{:d} dpi: scan {:.2f} process {:.2f} save {:.2f} sec'.format(
+            res, t1 - t0, t2 - t1, t3 - t2))
+    os.remove(fpath)
+
+    myscanner.Close()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+#
+# Pages processed in the background: the image settings applied to many
+# pages at once in a pool of processes, and the page being edited in a
+# thread
+#
+# The pages are processed by ProcessBuffer of imgprocess and come back one
+# by one as soon as they are done, as page buffers with their thumbnails,
+# through the notify callback.
+#
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import cv2
+import imgprocess as ipc
+from settings import *
+
+# background image of the worker process
+background = None
+
+#
+# worker process initialization
+#
+def init_worker(bgnd):
+    global background
+    background = bgnd
+    # the pages are spread over the processes already
+    ipc.TILE_THREADS = 1
+    cv2.setNumThreads(1)
+    # each page is processed once
+    ipc.STAGE_CACHE_BYTES = 0
+
+#
+# process a page in the worker process: the result and its thumbnail
+#
+def process_page(src, settings, profile):
+    res = ipc.ProcessBuffer(src, settings, background, profile)
+
+    return res, ipc.Thumbnail(res)
+
+
+#
+# notify(kind, job, data) from the pool thread, where kind is 'page' with
+# (result, thumbnail), 'error' with the message or 'done' with the batch
+# in place of the job and the number of pages. The callback must be thread
+# safe.
+#
+# A job is a dict of the page 'item' of the book, its 'settings' as they
+# were applied and the 'batch' it belongs to.
+#
+class PagePool:
+
+    def __init__(self, notify, workers=PROCESS_WORKERS):
+        self.notify = notify
+        self.workers = workers
+        # started on the first batch, again when the background changes
+        self.executor = None
+        self.background = None
+        # pages in progress
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    #
+    # process the pages of the book with their settings: return the batch
+    # immediately
+    #
+    def Apply(self, items, background=None):
+        if self.executor is None or background is not self.background:
+            self.Stop()
+            self.Start(background)
+
+        batch = {'count':len(items), 'done':0, 'aborted':False}
+        if len(items) == 0:
+            self.notify('done', batch, 0)
+            return batch
+
+        for item in items:
+            job = {'item':item, 'settings':item['settings'], 'batch':batch}
+            args = (process_page, item['src'], item['settings'],
+                    item.get('profile'))
+            try:
+                future = self.executor.submit(*args)
+            except BrokenProcessPool:
+                # a worker process died in between the batches
+                self.Broken(self.executor)
+                self.Start(background)
+                future = self.executor.submit(*args)
+            with self.lock:
+                self.pending[future] = job
+            future.add_done_callback(lambda f, executor=self.executor:
+                    self.Finished(f, executor))
+
+        return batch
+
+    #
+    # start the worker processes with the background
+    #
+    def Start(self, background):
+        # wx does not survive fork
+        self.executor = ProcessPoolExecutor(self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker, initargs=(background,))
+        self.background = background
+
+    #
+    # a page of the executor is done: called from the pool thread
+    #
+    def Finished(self, future, executor=None):
+        with self.lock:
+            job = self.pending.pop(future)
+            batch = job['batch']
+            batch['done'] = batch['done'] + 1
+            last = batch['done'] == batch['count']
+
+        # a worker process died: the executor is of no use any more
+        if not future.cancelled() and \
+                isinstance(future.exception(), BrokenProcessPool):
+            self.Broken(executor)
+
+        # results of the aborted batches are dropped
+        if not batch['aborted'] and not future.cancelled():
+            try:
+                data = future.result()
+            except Exception as e:
+                self.notify('error', job, str(e))
+            else:
+                self.notify('page', job, data)
+
+        if last:
+            self.notify('done', batch, batch['done'])
+
+    #
+    # forget the broken executor: a new one is started on the next batch
+    #
+    def Broken(self, executor):
+        with self.lock:
+            if executor is None or self.executor is not executor:
+                return
+            self.executor = None
+
+        executor.shutdown(wait=False)
+
+    #
+    # abort the batches in progress: the pages not yet started are
+    # cancelled, the others are let finish but dropped
+    #
+    def Abort(self):
+        with self.lock:
+            futures = list(self.pending.items())
+
+        for future, job in futures:
+            job['batch']['aborted'] = True
+            future.cancel()
+
+    def IsBusy(self):
+        return len(self.pending) > 0
+
+    #
+    # terminate the worker processes
+    #
+    def Stop(self):
+        if self.executor is not None:
+            self.Abort()
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+#
+# the page being edited processed in the background: the proxy first, then
+# the full resolution once the settings stop changing for a while
+#
+# Only the latest job is kept. A new one aborts the one in progress, so
+# that bursts of changes are processed once. notify(kind, job, data) from
+# this thread, where kind is 'proxy' or 'page' with (result, thumbnail), or
+# 'error' with the message.
+# A job is a dict of the page 'item' of the book, its 'settings', and the
+# 'background'.
+#
+class PageWorker(threading.Thread):
+
+    def __init__(self, notify, delay=PROXY_DELAY/1000.):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.notify = notify
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.job = None
+        self.stopped = False
+        self.aborted = threading.Event()
+
+    #
+    # replace the job pending or in progress
+    #
+    def Post(self, item, background=None):
+        job = {'item':item, 'settings':item['settings'],
+                'background':background}
+        with self.cond:
+            self.job = job
+            self.aborted.set()
+            self.cond.notify()
+
+        return job
+
+    #
+    # drop the job pending or in progress
+    #
+    def Abort(self):
+        with self.cond:
+            self.job = None
+            self.aborted.set()
+
+    #
+    # terminate the thread
+    #
+    def Stop(self):
+        with self.cond:
+            self.stopped = True
+            self.job = None
+            self.aborted.set()
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.job is not None or
+                        self.stopped)
+                if self.stopped:
+                    break
+                job = self.job
+                self.job = None
+                self.aborted.clear()
+
+            try:
+                self.Process(job)
+            except Exception as e:
+                self.notify('error', job, str(e))
+
+    #
+    # the proxy, then the full resolution if the settings stay
+    #
+    def Process(self, job):
+        item = job['item']
+        res = ipc.ProcessBuffer(item['proxy'], job['settings'],
+                job['background'], None, self.aborted)
+        if res is None:
+            return
+        self.notify('proxy', job, (res, ipc.Thumbnail(res)))
+
+        # no more changes for a while
+        with self.cond:
+            if self.cond.wait_for(lambda: self.job is not None or
+                    self.stopped, self.delay):
+                return
+
+        res = ipc.ProcessBuffer(item['src'], job['settings'],
+                job['background'], item.get('profile'), self.aborted)
+        if res is None:
+            return
+        self.notify('page', job, (res, ipc.Thumbnail(res)))
@@ -1,29 +1,216 @@
 #!/usr/bin/env python3
 #
 # This class provides abstraction layer to the python-sane
+# or to a module with the same interface such as mocksane
 #
+# A backend is a module with the interface of python-sane whose devices
+# also fill an image in place, snap_into(img, no_cancel, filled), calling
+# filled(lines) with the number of lines filled so far as the frame is
+# read. python-sane is given it by SaneBackend. python-sane gives the frame
+# only once it is read, so that the bands of a scan in progress are shown
+# with mocksane only: the page of a python-sane device is shown when done.
+#
+
+
+import importlib
+import json
+import os
+import queue
+import threading
+import time
+from PIL import Image
+
+# sane option type of the group titles
+TYPE_GROUP = 5
+# status message when the document feeder is empty
+NO_DOCS = 'Document feeder out of documents'
+
+# backends can be initialized only once
+initialized = []
+# scanners of the same pool share the cache
+cachelock = threading.Lock()
+# backends loaded by name
+backends = {}
+
+#
+# python-sane device with snap_into: python-sane reads the frame into its
+# own buffer and gives it at the end, so the image is filled at once then
+#
+class SaneDevice:
+
+    def __init__(self, dev):
+        self.__dict__['sanedev'] = dev
 
+    # options and methods are those of python-sane
+    def __getattr__(self, key):
+        return getattr(self.sanedev, key)
 
-import sane
+    def __setattr__(self, key, value):
+        setattr(self.sanedev, key, value)
+
+    def snap_into(self, img, no_cancel=False, filled=None):
+        img.paste(self.sanedev.snap(no_cancel))
+        if filled is not None:
+            filled(img.size[1])
+
+#
+# python-sane as a backend
+#
+class SaneBackend:
+
+    def __init__(self, sane):
+        self.sane = sane
+
+    def init(self):
+        return self.sane.init()
+
+    def exit(self):
+        self.sane.exit()
+
+    def get_devices(self, localOnly=False):
+        return self.sane.get_devices(localOnly)
+
+    def open(self, devname):
+        return SaneDevice(self.sane.open(devname))
+
+#
+# backend module by name: 'sane' for python-sane, or a module with the same
+# interface such as 'mocksane'
+#
+def LoadBackend(name='sane'):
+    if name not in backends:
+        backend = importlib.import_module(name)
+        if name == 'sane':
+            backend = SaneBackend(backend)
+        backends[name] = backend
+
+    return backends[name]
 
 class Scanner:
 
-    def __init__(self):
+    def __init__(self, cachefile=None, backend=None, cache=None):
+        # python-sane unless specified otherwise
+        if backend is None:
+            backend = LoadBackend()
+        self.sane = backend
         # initialize the sane
-        sane.init()
+        if backend not in initialized:
+            self.sane.init()
+            initialized.append(backend)
         self.device = None
         self.devlist = None
+        self.devcached = False
+        # option values written to the device
+        self.applied = {}
+        # device list and option tables from the previous runs
+        self.cachefile = cachefile
+        if cache is None:
+            self.cache = {'devices':None, 'options':{}}
+            self.LoadCache()
+        else:
+            self.cache = cache
+
+    #
+    # new instance for another device sharing the device list and cache
+    #
+    def Clone(self):
+        other = Scanner(self.cachefile, self.sane, self.cache)
+        other.devlist = self.devlist
+        other.devcached = self.devcached
+
+        return other
 
     #
     # enumeration of sane devices in the syatem
-    # this takes time
+    # this takes time, so the list of the previous run is used if any
     #
     def GetDevList(self):
         if self.devlist is None:
-            self.devlist = sane.get_devices()
+            if self.cache['devices']:
+                self.devlist = self.cache['devices']
+                self.devcached = True
+            else:
+                self.RefreshDevList()
 
         return self.devlist
 
+    #
+    # enumerate the devices again and update the cache
+    #
+    def RefreshDevList(self):
+        self.devlist = [tuple(x) for x in self.sane.get_devices()]
+        self.devcached = False
+        self.cache['devices'] = self.devlist
+        self.SaveCache()
+
+        return self.devlist
+
+    #
+    # load the cache file
+    #
+    def LoadCache(self):
+        if self.cachefile is None:
+            return
+
+        try:
+            with open(self.cachefile) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if cache.get('devices') is not None:
+            self.cache['devices'] = [tuple(x) for x in cache['devices']]
+        # range constraints are saved as dict since json has no tuple
+        for name, options in cache.get('options', {}).items():
+            self.cache['options'][name] = [
+                    tuple(x[:-1]) + (tuple(x[-1]['range']),)
+                    if isinstance(x[-1], dict) else tuple(x)
+                    for x in options]
+
+    #
+    # save the cache file: failure is not critical
+    #
+    def SaveCache(self):
+        if self.cachefile is None:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.cachefile) or '.',
+                    exist_ok=True)
+            with cachelock:
+                options = {}
+                for name, opts in self.cache['options'].items():
+                    options[name] = [
+                            list(x[:-1]) + [{'range':list(x[-1])}]
+                            if isinstance(x[-1], tuple) else list(x)
+                            for x in opts]
+                with open(self.cachefile, 'w') as f:
+                    json.dump({'devices':self.cache['devices'],
+                        'options':options}, f)
+        except OSError:
+            pass
+
+    #
+    # option table of the opened device
+    # the cached table is used as long as the option names match
+    #
+    def GetDevOptions(self, name):
+        options = self.cache['options'].get(name)
+
+        if options is not None:
+            # python-sane keeps the option names found on opening
+            names = set(x[1].replace('-','_') for x in options
+                    if x[4] != TYPE_GROUP)
+            if names == set(self.device.opt.keys()):
+                return options
+
+        options = self.device.get_options()
+        with cachelock:
+            self.cache['options'][name] = options
+        self.SaveCache()
+
+        return options
+
     #
     # open a device by index
     #
@@ -34,15 +221,16 @@ class Scanner:
             self.device = None
             return False
 
+        self.applied = {}
         try:
-            self.device = sane.open(self.devlist[idx][0])
+            self.device = self.sane.open(self.devlist[idx][0])
         except:
             self.device = None
             return False
         else:
             self.devname = self.devlist[idx][2]
             # retrieve option list
-            self.options = self.device.get_options()
+            self.options = self.GetDevOptions(self.devlist[idx][0])
             # mode: must be exist in the list
             for item in self.options:
                 if item[1] == 'mode':
@@ -51,26 +239,151 @@ class Scanner:
             for item in self.options:
                 if item[1] == 'resolution':
                     self.resolutions = item[-1]
-            # scan area:
-            self.areas = ['Letter', 'Legal', 'A4', 'A5', 'A6']
+            # source: flatbed, document feeder, etc. (optional)
+            self.sources = []
+            for item in self.options:
+                if item[1] == 'source':
+                    self.sources = item[-1]
+            # platen size in mm: range of the bottom-right corner
+            self.platen = [216, 356]
+            for item in self.options:
+                if item[1] in ('br-x', 'br-y') and item[-1] is not None:
+                    self.platen[item[1] == 'br-y'] = item[-1][1]
+            # scan area: 'Auto' reads the whole platen for preview
+            self.areas = ['Letter', 'Legal', 'A4', 'A5', 'A6', 'Auto']
             return True
 
+    #
+    # open a device by name, found in the device list of this scanner
+    #
+    def OpenDevice(self, name):
+        names = [x[0] for x in self.GetDevList()]
+
+        return self.Open(names.index(name) if name in names else -1)
+
     #
     # device must be closed before opening others
     #
     def Close(self):
         if self.device is not None:
             self.device.close()
+            self.device = None
+            self.applied = {}
+
+    #
+    # write an option unless it already has the value
+    # each write is a round trip to the device and may cause calibration
+    #
+    def SetOption(self, name, value):
+        if name in self.applied and self.applied[name] == value:
+            return False
+
+        # unknown state if the write fails
+        self.applied.pop(name, None)
+        setattr(self.device, name, value)
+        self.applied[name] = value
+
+        return True
+
+    #
+    # apply the scan settings together: only changed options are written
+    #
+    def Configure(self, mode=None, area=None, res=None):
+        if self.device is None:
+            return False
+
+        if mode is not None:
+            self.SetMode(mode)
+        if res is not None:
+            self.SetResolution(res)
+        if area is not None:
+            self.SetScanArea(area)
+
+        return True
+
+    #
+    # cancel the scan in progress: this can be called from any thread
+    #
+    def Cancel(self):
+        if self.device is not None:
+            self.device.cancel()
 
     #
     # scan an image from the scanner
+    # progress(top, band, size) is called with the bands read so far
     #
-    def ScanImage(self):
+    def ScanImage(self, progress=None, period=0.3):
         if self.device is None:
             return None
 
         self.device.start()
-        return self.device.snap()
+        return self.ReadImage(progress, period)
+
+    #
+    # read the frame started by device.start()
+    #
+    def ReadImage(self, progress=None, period=0.3, no_cancel=False):
+        if progress is None:
+            return self.device.snap(no_cancel)
+
+        fmt, last, (width, lines), depth, bpl = self.device.get_parameters()
+        # unknown page length or unusual format: read at once
+        if lines <= 0 or depth != 8 or fmt not in ('gray', 'color'):
+            img = self.device.snap(no_cancel)
+            progress(0, img, img.size)
+            return img
+
+        img = Image.new('L' if fmt == 'gray' else 'RGB', (width, lines))
+
+        # the lines filled in place are reported as a band at most every
+        # period, the last ones when the frame is read
+        band = {'top':0, 'time':time.time()}
+
+        def filled(bottom):
+            now = time.time()
+            if bottom > band['top'] and (bottom >= lines or
+                    now - band['time'] >= period):
+                progress(band['top'], img.crop((0, band['top'], width,
+                    bottom)), img.size)
+                band['top'], band['time'] = bottom, now
+
+        self.device.snap_into(img, no_cancel, filled)
+
+        return img
+
+    #
+    # scan pages from the document feeder until it is empty
+    # pages are yielded one by one as soon as they are read
+    #
+    def ScanBatch(self, progress=None, period=0.3):
+        if self.device is None:
+            return
+
+        # flatbed only: a single page
+        feeder = self.GetFeeder()
+        if feeder is None:
+            self.device.start()
+            yield self.ReadImage(progress, period)
+            return
+
+        # switch to the document feeder
+        source = self.device.source
+        self.SetOption('source', feeder)
+
+        try:
+            # same as the multi_scan iterator of python-sane
+            # but each page can be read progressively
+            while True:
+                try:
+                    self.device.start()
+                except Exception as e:
+                    if str(e) == NO_DOCS:
+                        break
+                    raise
+                yield self.ReadImage(progress, period, True)
+        finally:
+            # return to the original source
+            self.SetOption('source', source)
 
     #
     # return device name
@@ -81,6 +394,19 @@ class Scanner:
         else:
             return self.devname
 
+    #
+    # source name of the document feeder, None if there is none
+    #
+    def GetFeeder(self):
+        if self.device is None:
+            return None
+
+        for x in self.sources:
+            if 'adf' in x.lower() or 'feeder' in x.lower():
+                return x
+
+        return None
+
     #
     # get list of modes supported by the scanner
     #
@@ -106,7 +432,9 @@ class Scanner:
         if self.device is None:
             return False
         else:
-            self.device.mode = mode
+            if self.SetOption('mode', mode):
+                # backends may reload the other options on mode change
+                self.applied = {'mode':mode}
             return True
 
     #
@@ -124,28 +452,35 @@ class Scanner:
         else:
             return self.device.area
 
+    #
+    # area can be a paper size or (left, top, right, bottom) in mm
+    #
     def SetScanArea(self, area):
         if self.device is None:
             return False
+        elif isinstance(area, tuple):
+            (tl_x, tl_y, br_x, br_y) = area
         else:
-            self.device.tl_x = 0
-            self.device.tl_y = 0
-            if area == 'A4' or area == 'a4':
-                self.device.br_x = 210
-                self.device.br_y = 297
+            tl_x = 0
+            tl_y = 0
+            if area == 'Auto' or area == 'auto':
+                (br_x, br_y) = self.platen
+            elif area == 'A4' or area == 'a4':
+                (br_x, br_y) = (210, 297)
             elif area == 'A5' or area == 'a5':
-                self.device.br_x = 148
-                self.device.br_y = 210
+                (br_x, br_y) = (148, 210)
             elif area == 'A6' or area == 'a6':
-                self.device.br_x = 105
-                self.device.br_y = 148
+                (br_x, br_y) = (105, 148)
             elif area == 'Legal' or area == 'legal':
-                self.device.br_x = 216
-                self.device.br_y = 356
+                (br_x, br_y) = (216, 356)
             else:
-                self.device.br_x = 216
-                self.device.br_y = 279
-            return True
+                (br_x, br_y) = (216, 279)
+
+        self.SetOption('tl_x', tl_x)
+        self.SetOption('tl_y', tl_y)
+        self.SetOption('br_x', br_x)
+        self.SetOption('br_y', br_y)
+        return True
 
     def GetResolutions(self):
         if self.device is None:
@@ -153,6 +488,22 @@ class Scanner:
         else:
             return self.resolutions
 
+    #
+    # lowest resolution not less than the given one
+    #
+    def GetPreviewResolution(self, res):
+        if self.device is None:
+            return None
+        # range constraint: (min, max, quantization)
+        elif isinstance(self.resolutions, tuple):
+            return max(self.resolutions[0], min(self.resolutions[1], res))
+        else:
+            higher = [x for x in self.resolutions if x >= res]
+            if len(higher):
+                return min(higher)
+            else:
+                return max(self.resolutions)
+
     def GetResolution(self):
         if self.device is None:
             return None
@@ -163,7 +514,7 @@ class Scanner:
         if self.device is None:
             return None
         else:
-            self.device.resolution = res
+            self.SetOption('resolution', res)
             return True
 
     def GetOptions(self):
@@ -172,6 +523,205 @@ class Scanner:
         else:
             return self.options
 
+
+#
+# acquisition thread that owns the scanner
+#
+# Once started, every access to the device must go through this thread.
+# Jobs are queued by Post() and the result is reported by calling
+# notify(kind, job, data) from this thread, where kind is one of
+# 'progress', 'band', 'page', 'done' or 'error'. The callback must be
+# thread safe.
+#
+class ScanWorker(threading.Thread):
+
+    def __init__(self, scanner, notify, period=0.3):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.scanner = scanner
+        self.notify = notify
+        # interval of the progressive scan bands
+        self.period = period
+        self.jobs = queue.Queue()
+        self.aborted = threading.Event()
+
+    #
+    # queue a job and return immediately
+    #
+    def Post(self, cmd, **kwds):
+        job = dict(kwds, cmd=cmd)
+        self.jobs.put(job)
+        return job
+
+    #
+    # close the device and terminate the thread after the pending jobs
+    #
+    def Stop(self):
+        self.jobs.put(None)
+
+    #
+    # abort the scan in progress: called from other threads
+    #
+    def Abort(self):
+        self.aborted.set()
+        self.scanner.Cancel()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.scanner.Close()
+                break
+
+            self.aborted.clear()
+            try:
+                data = self.Execute(job)
+            except Exception as e:
+                if self.aborted.is_set():
+                    self.notify('error', job, 'scan aborted')
+                else:
+                    self.notify('error', job, str(e))
+            else:
+                self.notify('done', job, data)
+
+    #
+    # carry out a job in this thread
+    #
+    def Execute(self, job):
+        cmd = job['cmd']
+
+        if cmd == 'devlist':
+            devlist = self.scanner.GetDevList()
+            # cached list must be verified by the 'refresh' job
+            job['cached'] = self.scanner.devcached
+            return devlist
+
+        elif cmd == 'refresh':
+            return self.scanner.RefreshDevList()
+
+        elif cmd == 'open':
+            self.scanner.Close()
+            return self.scanner.OpenDevice(job['device'])
+
+        elif cmd == 'scan':
+            self.Setup(job)
+            self.notify('progress', job, None)
+            return self.scanner.ScanImage(self.Bands(job), self.period)
+
+        elif cmd == 'batch':
+            self.Setup(job)
+
+            # each page is handed over as soon as it is read
+            count = 0
+            self.notify('progress', job, count)
+            for img in self.scanner.ScanBatch(self.Bands(job), self.period):
+                count = count + 1
+                self.notify('page', job, img)
+                if self.aborted.is_set():
+                    break
+                self.notify('progress', job, count)
+
+            return count
+
+        else:
+            raise ValueError('unknown job: ' + cmd)
+
+    #
+    # progress callback reporting the bands of the page being read
+    #
+    def Bands(self, job):
+        return lambda top, band, size: self.notify('band', job,
+                (top, band, size))
+
+    #
+    # apply the scan parameters of the job: they are optional
+    #
+    def Setup(self, job):
+        self.scanner.Configure(job.get('mode'), job.get('size'),
+                job.get('res'))
+
+
+#
+# scanners opened at the same time, each with its own acquisition thread
+#
+# The scanner given is used to enumerate the devices only. Jobs for a
+# device are tagged with its name in the 'device' key.
+#
+class ScannerPool:
+
+    def __init__(self, scanner, notify, period=0.3):
+        self.scanner = scanner
+        self.notify = notify
+        self.period = period
+        # device enumeration has its own thread
+        self.enumerator = ScanWorker(scanner, notify, period)
+        self.enumerator.start()
+        # acquisition threads by device name
+        self.workers = {}
+
+    #
+    # enumeration jobs: 'devlist' and 'refresh'
+    #
+    def Post(self, cmd, **kwds):
+        return self.enumerator.Post(cmd, **kwds)
+
+    #
+    # open a device by name in a new thread
+    #
+    def Open(self, device, **kwds):
+        if device not in self.workers:
+            worker = ScanWorker(self.scanner.Clone(), self.notify,
+                    self.period)
+            worker.start()
+            self.workers[device] = worker
+
+        return self.workers[device].Post('open', device=device, **kwds)
+
+    #
+    # close a device
+    #
+    def Close(self, name):
+        if name in self.workers:
+            self.workers.pop(name).Stop()
+
+    def IsOpen(self, name):
+        return name in self.workers
+
+    #
+    # queue a job to the device
+    #
+    def PostTo(self, name, cmd, **kwds):
+        return self.workers[name].Post(cmd, device=name, **kwds)
+
+    #
+    # scanner of the device: only the cached properties are safe to use
+    # from other threads (modes, resolutions, areas, platen, feeder)
+    #
+    def GetScanner(self, name):
+        if name in self.workers:
+            return self.workers[name].scanner
+        else:
+            return None
+
+    #
+    # abort all the scans in progress
+    #
+    def Abort(self):
+        for worker in self.workers.values():
+            worker.Abort()
+
+    #
+    # close all the devices and terminate the threads
+    #
+    def Stop(self):
+        workers = [self.enumerator] + list(self.workers.values())
+        self.workers = {}
+
+        for worker in workers:
+            worker.Stop()
+        for worker in workers:
+            worker.join()
+
 if __name__=='__main__':
 
     print('Initialization -------------------------------')
@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
-import wx
+import os
 
 PROGRAM_TITLE = 'InnoScan'
 # width height ratio of letter paper
 INITIAL_PANEL_SIZE = (int(216*2.3),int(297*2.3))
 THUMBNAIL_SIZE = (int(216*0.4), int(297*0.4))
-# quality of screen resizing
-RESIZE_QUALITY = wx.IMAGE_QUALITY_BICUBIC
+# quality of screen resizing: 'Nearest', 'Bilinear', 'Bicubic', 'Lanczos'
+RESIZE_QUALITY = 'Bicubic'
+# display pyramid levels down to this size (longest side)
+PYRAMID_MIN_SIZE = 256
+
+# scanner backend: 'sane' or 'mocksane' which replays image files
+SCAN_BACKEND = os.environ.get('INNOSCAN_BACKEND', 'sane')
 
 # default scanner settings
 # note that this must match with actual scanner parameter
@@ -18,12 +23,27 @@ DEFAULT_TXT_SIZE = 'Letter'
 DEFAULT_IMG_MODE = 'Color'
 DEFAULT_IMG_RES = 300
 DEFAULT_IMG_SIZE = 'Letter'
+# scan from the document feeder until it is empty
+DEFAULT_TXT_ADF = False
+DEFAULT_IMG_ADF = False
+# interval (sec) of the scan preview bands
+SCAN_BAND_PERIOD = 0.3
+# 'Auto' scan area: low resolution preview of the platen then full scan
+# of the content only
+PREVIEW_RES = 75
+PREVIEW_MARGIN = 3      # mm around the content
+CONTENT_THOLD = 40      # difference from the platen background
+CONTENT_MAX_RATIO = 0.9 # scan the whole platen if content is larger
 
-# anti-halftone filter parameters
-GB_RADIUS = 1.0
-UM_RADIUS = 2.5
-UM_PERCENT = 130
-UM_THOLD = 5
+# anti-halftone: screen found in the spectrum of a tile of this size
+DESCREEN_SIZE = 512
+# peaks of the screen: at most this many, this much above the spectrum
+# around (log), and faster than this (cycles per pixel)
+DESCREEN_PEAKS = 64
+DESCREEN_PROMINENCE = 3.0
+DESCREEN_MIN_FREQ = 0.04
+# width of the notches on the peaks and their harmonics (cycles per pixel)
+DESCREEN_NOTCH = 0.008
 
 # background image alpha channel parameters
 ALPHA_THOLD = 220       # threshold value
@@ -48,12 +68,31 @@ FONT_DIR = './res/'
 WATERMARK_PNT = 100
 # alpha blending
 WATERMARK_OPQ = 70
+# rendered watermark and background layers kept in memory (bytes)
+LAYER_CACHE_BYTES = 256 * 2**20
+# outputs of the processing stages kept in memory (bytes)
+STAGE_CACHE_BYTES = 512 * 2**20
+# settings changes shown on a copy of the page of the display size first,
+# the full resolution processed after the changes stop for a while (msec)
+PROXY_SIZE = INITIAL_PANEL_SIZE
+PROXY_DELAY = 800
+
+# tiled processing: rows of a tile (0 for the whole page at once)
+TILE_ROWS = 256
+# threads working on the tiles
+TILE_THREADS = os.cpu_count() or 1
+# processes applying the settings to many pages
+PROCESS_WORKERS = os.cpu_count() or 1
 
-# canny edge initial threshold (before calibration)
-CANNY_LOW = 50
-CANNY_HIGH = 180
+# canny edge thresholds calibrated on the middle of the page of this size
+CANNY_CALIB_SIZE = 800
 # hough lines threshold
 HOUGH_THLIST = (300,250,200,100)
+# rectification estimated on a reduced copy of this size (longest side)
+RECT_COARSE_SIZE = 800
+# resampling of the rectified document:
+# 'Nearest', 'Bilinear', 'Bicubic' or 'Lanczos'
+RECT_QUALITY = 'Bicubic'
 
 # color scheme data
 color_schemes = {
@@ -113,6 +152,20 @@ SAVEFILETYPE = 'BMP,EPS,GIF,JPG,PNG files(*.bmp;*.eps;*.gif;*.jpg;*.png)|' \
 JPGQUALITY = 90
 PNGOPTIMIZ = False
 
+# device list and option tables of the previous runs
+CACHE_DIR = './cache/'
+DEVICE_CACHE = CACHE_DIR + 'devices_' + SCAN_BACKEND + '.json'
+
+# mocksane: image files served as scans
+MOCK_FILES = IMAGE_DIR + '/*.jpg'
+MOCK_DEVICES = 1            # number of devices
+MOCK_MODES = ['Color', 'Gray', 'Lineart']
+MOCK_RESOLUTIONS = [75, 150, 300, 600]
+MOCK_PLATEN = (216, 297)    # mm
+MOCK_LINE_DELAY = 0.001     # sec per line read
+MOCK_ADF_PAGES = 5          # pages in the document feeder
+MOCK_FAIL_RATE = 0.0        # probability of an I/O error on each scan
+
 
 if __name__ == "__main__":
     print('')